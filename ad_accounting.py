@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+import logging
+import time
+from sqlalchemy import func, select, true, update
+from sqlalchemy.orm import Session
+from config import AD_IMPRESSION_PRICE, AD_CLICK_PRICE, ROLLUP_OVERLAP_SECONDS
+from database_connection import SessionLocal
+from models import Advertisement, FactAdMetricsDaily, RollupState
+from reporting import count_true
+from ad_index import bump_version_statement
+from click_aggregator import flush_click_aggregator
+
+logger = logging.getLogger(__name__)
+
+# High-water mark of the spend settlement, kept in rollup_state
+SPEND_STATE_NAME = "ad_spend"
+
+# Result of the last run in this process, for /cron-status
+ad_expiry_status = {}
+
+
+def delivered_spend_query(changed):
+    return (
+        select(
+            FactAdMetricsDaily.advertise_id,
+            (
+                count_true(FactAdMetricsDaily.impressions) * AD_IMPRESSION_PRICE
+                + func.coalesce(func.sum(FactAdMetricsDaily.clicks), 0) * AD_CLICK_PRICE
+            ).label("spend"),
+        )
+        .where(
+            FactAdMetricsDaily.advertise_id.in_(
+                select(FactAdMetricsDaily.advertise_id).where(changed)
+            ),
+            FactAdMetricsDaily.advertise_id.in_(
+                select(Advertisement.id).where(Advertisement.is_ad_active.is_(True))
+            ),
+        )
+        .group_by(FactAdMetricsDaily.advertise_id)
+        .subquery()
+    )
+
+
+# Two set-based statements in one transaction. The first is an UPDATE ...
+# FROM that recomputes the delivered spend of the live ads with facts written
+# or changed since the last run, like the rollup: a high-water mark on
+# updated_at, minus an overlap window, finds them, and recomputing a whole ad
+# is idempotent. Ads without new facts are not read at all. The second
+# deactivates every ad whose ends_at has passed. Spend is settled first, so
+# an ad that expires in this run keeps its final figure.
+def expire_ads(db: Session) -> dict:
+    started = time.perf_counter()
+    state = db.get(RollupState, SPEND_STATE_NAME, with_for_update=True)
+    if state is None:
+        state = RollupState(name=SPEND_STATE_NAME)
+        db.add(state)
+
+    changed = true()
+    if state.high_water_mark:
+        changed = FactAdMetricsDaily.updated_at > state.high_water_mark - timedelta(
+            seconds=ROLLUP_OVERLAP_SECONDS
+        )
+    facts_processed, high_water_mark = db.execute(
+        select(func.count(), func.max(FactAdMetricsDaily.updated_at)).where(changed)
+    ).one()
+
+    ads_accounted = 0
+    if facts_processed:
+        spend = delivered_spend_query(changed)
+        ads_accounted = db.execute(
+            update(Advertisement)
+            .where(Advertisement.id == spend.c.advertise_id)
+            .values(delivered_spend=spend.c.spend)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    ads_expired = db.execute(
+        update(Advertisement)
+        .where(
+            Advertisement.is_ad_active.is_(True),
+            Advertisement.ends_at <= datetime.now(),
+        )
+        .values(is_ad_active=False)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if ads_expired:
+        # Workers reload their active-ad index on the next version check
+        db.execute(bump_version_statement)
+
+    if high_water_mark and (
+        state.high_water_mark is None or high_water_mark > state.high_water_mark
+    ):
+        state.high_water_mark = high_water_mark
+    state.last_run_at = datetime.now()
+    state.rows_processed = facts_processed
+    state.groups_refreshed = ads_accounted
+    state.duration_ms = int((time.perf_counter() - started) * 1000)
+    db.commit()
+    return {
+        "last_run": state.last_run_at.isoformat(),
+        "facts_processed": facts_processed,
+        "ads_accounted": ads_accounted,
+        "ads_expired": ads_expired,
+        "duration_ms": state.duration_ms,
+    }
+
+
+def run_ad_expiry():
+    # Clicks buffered in this worker count towards spend from this run on;
+    # other workers' buffers arrive within CLICK_FLUSH_INTERVAL_SECONDS
+    flush_click_aggregator()
+    db = SessionLocal()
+    try:
+        ad_expiry_status.update(expire_ads(db))
+        ad_expiry_status.pop("last_error", None)
+        ad_expiry_status.pop("last_error_at", None)
+        if ad_expiry_status["ads_expired"]:
+            logger.info(
+                f"Deactivated {ad_expiry_status['ads_expired']} expired ads, "
+                f"spend updated for {ad_expiry_status['ads_accounted']}"
+            )
+    except Exception as e:
+        db.rollback()
+        ad_expiry_status["last_error"] = str(e)
+        ad_expiry_status["last_error_at"] = datetime.now().isoformat()
+        logger.error(f"Ad expiry failed: {e}")
+    finally:
+        db.close()
@@ -0,0 +1,158 @@
+import heapq
+import logging
+import random
+import threading
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import insert, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database_connection import engine
+from models import Advertisement, CacheVersion
+from schemas import AdvertisementSchema
+
+logger = logging.getLogger(__name__)
+
+AD_INDEX_NAME = "active_ads"
+
+ad_fields = list(AdvertisementSchema.model_fields)
+ad_columns = [getattr(Advertisement, field) for field in ad_fields]
+active_ads_query = select(*ad_columns, Advertisement.ends_at).where(
+    Advertisement.is_ad_active.is_(True)
+)
+
+
+def ad_expiry(ad: dict) -> Optional[datetime]:
+    if ad.get("ends_at"):
+        return ad["ends_at"]
+    try:
+        return datetime.strptime(
+            f"{ad['advertise_end_date']} {ad['advertise_end_time']}", "%Y-%m-%d %H:%M"
+        )
+    except (TypeError, ValueError):
+        # No usable end date: the ad runs until it is deactivated
+        return None
+
+
+# Live advertisements of this worker. Ads sit in a dict for lookups and in a
+# list for O(1) random picks (removal swaps the last entry into the hole); a
+# heap ordered by expiry lets expired ads drop out in O(log n) each. Heap
+# entries are never removed early: a popped entry whose expiry no longer
+# matches the ad's is just skipped.
+class ActiveAdIndex:
+    def __init__(self):
+        self.ads = {}  # id -> (ad dict, expiry)
+        self.ids = []
+        self.positions = {}  # id -> index in self.ids
+        self.expiry = []  # heap of (expiry, id)
+        self.version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ads)
+
+    def _add(self, ad: dict, now: datetime):
+        ends_at = ad_expiry(ad)
+        if ends_at is not None and ends_at <= now:
+            if ad["id"] in self.ads:
+                self._remove(ad["id"])
+            return
+        if ad["id"] not in self.ads:
+            self.positions[ad["id"]] = len(self.ids)
+            self.ids.append(ad["id"])
+        self.ads[ad["id"]] = (ad, ends_at)
+        if ends_at is not None:
+            heapq.heappush(self.expiry, (ends_at, ad["id"]))
+
+    def _remove(self, ad_id: str):
+        del self.ads[ad_id]
+        position = self.positions.pop(ad_id)
+        last = self.ids.pop()
+        if last != ad_id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def _expire(self, now: datetime) -> int:
+        expired = 0
+        while self.expiry and self.expiry[0][0] <= now:
+            ends_at, ad_id = heapq.heappop(self.expiry)
+            entry = self.ads.get(ad_id)
+            if entry is not None and entry[1] == ends_at:
+                self._remove(ad_id)
+                expired += 1
+        return expired
+
+    def replace(self, ads: list, version: int):
+        now = datetime.now()
+        with self._lock:
+            self.ads, self.ids, self.positions, self.expiry = {}, [], {}, []
+            for ad in ads:
+                self._add(ad, now)
+            self.version = version
+
+    # A change made by this worker. The index version only moves forward if
+    # it was the next one; otherwise another worker changed something too and
+    # the next version check reloads.
+    def add(self, ad: dict, version: int):
+        with self._lock:
+            self._add(ad, datetime.now())
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def choose(self) -> Optional[dict]:
+        with self._lock:
+            self._expire(datetime.now())
+            if not self.ids:
+                return None
+            return self.ads[random.choice(self.ids)][0]
+
+
+active_ads = ActiveAdIndex()
+
+version_query = select(CacheVersion.version).where(CacheVersion.name == AD_INDEX_NAME)
+
+
+def load_ad_index(engine: Engine):
+    try:
+        with engine.begin() as conn:
+            if conn.execute(version_query).scalar() is None:
+                conn.execute(insert(CacheVersion).values(name=AD_INDEX_NAME, version=0))
+    except IntegrityError:
+        # Another worker created the row first
+        pass
+    with engine.connect() as conn:
+        version = conn.execute(version_query).scalar()
+        ads = [dict(row) for row in conn.execute(active_ads_query).mappings()]
+    active_ads.replace(ads, version)
+
+
+# One version lookup, and a full reload only when another worker changed the
+# advertisements since. Run by the scheduler every AD_INDEX_CHECK_SECONDS, so
+# requests read the index without waiting on either.
+def refresh_ad_index(engine: Engine):
+    with engine.connect() as conn:
+        version = conn.execute(version_query).scalar()
+        if version != active_ads.version:
+            ads = [dict(row) for row in conn.execute(active_ads_query).mappings()]
+            active_ads.replace(ads, version)
+
+
+def run_ad_index_refresh():
+    try:
+        refresh_ad_index(engine)
+    except Exception as e:
+        logger.error(f"Ad index refresh failed: {e}")
+
+
+# Run in the same transaction as the change to the advertisements
+bump_version_statement = (
+    update(CacheVersion)
+    .where(CacheVersion.name == AD_INDEX_NAME)
+    .values(version=CacheVersion.version + 1)
+    .returning(CacheVersion.version)
+)
+
+
+async def bump_ad_index_version(db: AsyncSession) -> int:
+    return await db.scalar(bump_version_statement)
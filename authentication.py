@@ -1,24 +1,42 @@
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from config import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY
+from config import (
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    ALGORITHM,
+    SECRET_KEY,
+    TOKEN_CACHE_SIZE,
+    PRINCIPAL_CACHE_SIZE,
+    PRINCIPAL_CACHE_TTL_SECONDS,
+)
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from models import User
+from cache import LRUCache
+import time
 from typing import Optional
 from fastapi import HTTPException, status
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from hasher import password_hasher
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login-user", auto_error=False)
 
+# Verified token payloads, each kept until the token's own exp
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+# user id -> the user fields the hot paths need
+principal_cache = LRUCache(
+    maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL_SECONDS
+)
+
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify_and_update_async(
+        plain_password, hashed_password
+    )
 
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    return (await db.scalars(select(User).where(User.email == email).limit(1))).first()
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -33,8 +51,14 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 def decode_access_token(token: str) -> Optional[dict]:
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        expires_in = payload.get("exp", 0) - time.time()
+        if expires_in > 0:
+            token_cache.set(token, payload, ttl=expires_in)
         return payload
     except JWTError as e:
         if "expired" in str(e).lower():
@@ -50,10 +74,85 @@ def decode_access_token(token: str) -> Optional[dict]:
         )
 
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = get_user_by_email(db, email)
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email(db, email)
     if not user:
         return None
-    if not verify_password(password, user.password):
+    verified, new_hash = await verify_password(password, user.password)
+    if not verified:
         return None
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
     return user
+
+
+def principal_from_row(row) -> dict:
+    return {
+        "id": row.id,
+        "gender_id": row.gender_id,
+        "is_superadmin": row.is_superadmin,
+    }
+
+
+principal_query = select(User.id, User.gender_id, User.is_superadmin)
+
+
+async def get_principal(db: AsyncSession, user_id: str) -> Optional[dict]:
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+    row = (await db.execute(principal_query.where(User.id == user_id))).first()
+    if not row:
+        return None
+    principal = principal_from_row(row)
+    principal_cache.set(user_id, principal)
+    return principal
+
+
+def get_principal_sync(db: Session, user_id: str) -> Optional[dict]:
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+    row = db.execute(principal_query.where(User.id == user_id)).first()
+    if not row:
+        return None
+    principal = principal_from_row(row)
+    principal_cache.set(user_id, principal)
+    return principal
+
+
+# Verified token payload of the caller of a logged-in endpoint
+def require_login(token: Optional[str]) -> dict:
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Please Login First...!",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return decode_access_token(token)
+
+
+async def require_superadmin(db: AsyncSession, token: Optional[str]) -> dict:
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    principal = await get_principal(db, decode_access_token(token).get("id"))
+    if not principal or not principal["is_superadmin"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Superadmin only"
+        )
+    return principal
+
+
+def invalidate_principal(user_id: str):
+    principal_cache.pop(user_id)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_changed_user(mapper, connection, target):
+    invalidate_principal(target.id)
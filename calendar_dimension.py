@@ -0,0 +1,68 @@
+from datetime import date, datetime, timedelta
+from typing import Union
+from sqlalchemy import func, insert, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from config import CALENDAR_START_DATE, CALENDAR_DAYS_AHEAD
+from models import DimCalendar, FactAdMetricsDaily
+
+
+def to_date_key(value: Union[date, str]) -> int:
+    if isinstance(value, str):
+        value = datetime.strptime(value, "%Y-%m-%d")
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def from_date_key(date_key: int) -> date:
+    return date(date_key // 10000, date_key // 100 % 100, date_key % 100)
+
+
+def calendar_row(day: date) -> dict:
+    return {
+        "date_key": to_date_key(day),
+        "date": day.strftime("%Y-%m-%d"),
+        "year": day.year,
+        "quarter": (day.month - 1) // 3 + 1,
+        "month": day.month,
+        "day": day.day,
+        "day_of_week": day.isoweekday(),
+        "iso_week": day.isocalendar()[1],
+        "is_weekend": day.isoweekday() >= 6,
+    }
+
+
+def populate_calendar(conn: Connection, start: date, end: date) -> int:
+    existing = set(
+        conn.execute(
+            select(DimCalendar.date_key).where(
+                DimCalendar.date_key.between(to_date_key(start), to_date_key(end))
+            )
+        ).scalars()
+    )
+    rows = [
+        calendar_row(start + timedelta(days=offset))
+        for offset in range((end - start).days + 1)
+    ]
+    rows = [row for row in rows if row["date_key"] not in existing]
+    if rows:
+        conn.execute(insert(DimCalendar), rows)
+    return len(rows)
+
+
+# Keeps the calendar covering CALENDAR_START_DATE (or the oldest event, if
+# earlier) through CALENDAR_DAYS_AHEAD from today. Safe to run on every start.
+def ensure_calendar(engine: Engine) -> int:
+    start = datetime.strptime(CALENDAR_START_DATE, "%Y-%m-%d").date()
+    try:
+        with engine.begin() as conn:
+            oldest = conn.execute(
+                select(func.min(FactAdMetricsDaily.date_key))
+            ).scalar()
+            if oldest and from_date_key(oldest) < start:
+                start = from_date_key(oldest)
+            return populate_calendar(
+                conn, start, date.today() + timedelta(days=CALENDAR_DAYS_AHEAD)
+            )
+    except IntegrityError:
+        # Another worker filled the same days first
+        return 0
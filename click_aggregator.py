@@ -0,0 +1,133 @@
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+from typing import Optional
+import logging
+import threading
+from cache import LRUCache
+from config import CLICK_DURABILITY, CLICK_ROW_CACHE_SIZE
+from database_connection import SessionLocal
+from models import FactAdMetricsDaily
+
+logger = logging.getLogger(__name__)
+
+fact_table = FactAdMetricsDaily.__table__
+
+# date_key is part of every update so a partitioned fact table only probes
+# the partition of the row's day
+flush_clicks_statement = (
+    fact_table.update()
+    .where(
+        fact_table.c.id == bindparam("fact_id"),
+        fact_table.c.date_key == bindparam("fact_date_key"),
+    )
+    .values(clicks=fact_table.c.clicks + bindparam("increment"), conversions=True)
+)
+
+
+def increment_clicks(
+    db: Session, fact_id: str, date_key: int, increment: int = 1
+) -> int:
+    clicks = db.execute(
+        update(FactAdMetricsDaily)
+        .where(
+            FactAdMetricsDaily.id == fact_id, FactAdMetricsDaily.date_key == date_key
+        )
+        .values(clicks=FactAdMetricsDaily.clicks + increment, conversions=True)
+        .returning(FactAdMetricsDaily.clicks)
+    ).scalar_one()
+    db.commit()
+    return clicks
+
+
+# Absorbs click/conversion increments per (user, advertisement, day) row and
+# writes them back as one batched UPDATE per flush.
+class ClickAggregator:
+    def __init__(self, durability: str = CLICK_DURABILITY):
+        self.durability = durability
+        # (user, advertisement, day) -> {"id": fact id, "row": last known row}
+        self.rows = LRUCache(maxsize=CLICK_ROW_CACHE_SIZE)
+        # fact id -> [pending clicks, row key]
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def get_row(self, key) -> Optional[dict]:
+        return self.rows.get(key)
+
+    def remember(self, key, fact_id: str, row: dict) -> dict:
+        entry = {"id": fact_id, "row": row}
+        self.rows.set(key, entry)
+        return entry
+
+    def record_click(self, key, entry: dict, db: Optional[Session] = None) -> dict:
+        if self.durability == "sync":
+            clicks = increment_clicks(db, entry["id"], key[2])
+            with self._lock:
+                entry["row"]["clicks"] = clicks
+                entry["row"]["conversions"] = True
+                return dict(entry["row"])
+
+        with self._lock:
+            increment = self.pending.setdefault(entry["id"], [0, key])
+            increment[0] += 1
+            row = dict(entry["row"])
+            row["clicks"] = (row["clicks"] or 0) + increment[0]
+        row["conversions"] = True
+        return row
+
+    def drain(self) -> dict:
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def flush(self, db: Optional[Session] = None) -> int:
+        pending = self.drain()
+        if not pending:
+            return 0
+
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            db.execute(
+                flush_clicks_statement,
+                [
+                    {"fact_id": fact_id, "fact_date_key": key[2], "increment": clicks}
+                    for fact_id, (clicks, key) in pending.items()
+                ],
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.restore(pending)
+            logger.error(f"Click flush failed, {len(pending)} rows re-queued: {e}")
+            raise
+        finally:
+            if own_session:
+                db.close()
+
+        with self._lock:
+            for fact_id, (clicks, key) in pending.items():
+                entry = self.rows.get(key)
+                if entry and entry["id"] == fact_id:
+                    row = entry["row"]
+                    row["clicks"] = (row["clicks"] or 0) + clicks
+                    row["conversions"] = True
+        return len(pending)
+
+    def restore(self, pending: dict):
+        with self._lock:
+            for fact_id, (clicks, key) in pending.items():
+                increment = self.pending.setdefault(fact_id, [0, key])
+                increment[0] += clicks
+
+
+click_aggregator = ClickAggregator()
+
+
+def flush_click_aggregator():
+    try:
+        rows = click_aggregator.flush()
+        if rows:
+            logging.info(f"Flushed clicks for {rows} fact rows")
+    except Exception:
+        # Already logged and re-queued for the next run
+        pass
@@ -1,3 +1,5 @@
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import Optional
 from schemas import UserSchemas, FactAdMetricsDailySchemas, AdvertisementSchema
@@ -13,21 +15,27 @@ from models import (
     Guestuser,
     Advertisement,
 )
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
 from datetime import datetime, timedelta
-from generate_system_report import get_current_info
 import bcrypt
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
-from authentication import decode_access_token
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from authentication import decode_access_token, get_principal
+from hasher import password_hasher
+from dimension_registry import get_or_create_dimension
+from ingest_service import ingest_event, ingest_batch
+from config import BULK_MAX_EVENTS, AD_IMPRESSION_PRICE, AD_CLICK_PRICE
+from click_aggregator import click_aggregator
+from calendar_dimension import to_date_key
+from ad_index import active_ads, bump_ad_index_version
+from pacing import enforce_pacing
+from identifiers import is_valid_id
+import json
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
 def hash_password(password: str):
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
 
 
 def calculate_advertise_end_datetime(hours):
@@ -53,85 +61,14 @@ def calculate_age(birth_date_str):
     return age
 
 
-def get_or_create_gender(db: Session, gender: str = None) -> DimGender:
-    gender = gender or "unknown"
-    gender_data = db.query(DimGender).filter(DimGender.gender == gender).first()
-    if gender_data:
-        return gender_data
-    new_record = DimGender(gender=gender.lower())
-    db.add(new_record)
-    db.commit()
-    db.refresh(new_record)
-    return new_record
-
-
-def get_dim_dates(db: Session):
-    record = DimDates(
-        date_created=datetime.now().strftime("%Y-%m-%d"),
-        time_created=datetime.now().strftime("%H:%M"),
-    )
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return record
-
-
-def get_dim_region(db: Session):
-    current_info = get_current_info()
-    record = DimRegion(
-        regionname=current_info["region"],
-        cityname=current_info["city"],
-        countryname=current_info["country"],
-    )
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return record
-
-
-def get_dim_device_info(db: Session):
-    current_info = get_current_info()
-    record = DimDeviceType(
-        device_name=f"{current_info['device_company']} {current_info['device_type']}"
-    )
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return record
-
+def get_or_create_gender(db: Session, gender: str = None) -> str:
+    gender = (gender or "unknown").lower()
+    return get_or_create_dimension(db, DimGender, gender=gender)
 
-def get_dim_platform_info(db: Session):
-    current_info = get_current_info()
-    record = DimPlatform(
-        platform_name=current_info["platform"],
-        platform_hostname=current_info["platform_hostname"],
-    )
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return record
-
-
-def get_guest_user(db: Session):
-    current_info = get_current_info()
-    record = Guestuser(
-        ip_address=current_info["ip"],
-        guest_name=current_info["name"],
-        location=current_info["location"],
-    )
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return record.id
 
-
-def get_age(db: Session, dob):
+def get_age(db: Session, dob) -> str:
     age = calculate_age(dob)
-    record = DimAgeGroup(age_range=age)
-    db.add(record)
-    db.commit()
-    db.refresh(record)
-    return record
+    return get_or_create_dimension(db, DimAgeGroup, age_range=str(age))
 
 
 def create_user_data(db: Session, user_data: UserSchemas):
@@ -144,8 +81,8 @@ def create_user_data(db: Session, user_data: UserSchemas):
             email=user_data.email,
             dateofbirth=user_data.dateofbirth,
             is_superadmin=user_data.is_superadmin,
-            agegroup_id=age_group_id.id,
-            gender_id=gender_id.id,
+            agegroup_id=age_group_id,
+            gender_id=gender_id,
             password=hashed_password,
         )
 
@@ -159,8 +96,8 @@ def create_user_data(db: Session, user_data: UserSchemas):
             email=user.email,
             dateofbirth=user.dateofbirth,
             is_superadmin=user.is_superadmin,
-            age_range=age_group_id.age_range,
-            gender=gender_id.gender,
+            age_range=str(calculate_age(user_data.dateofbirth)),
+            gender=(user_data.gender or "unknown").lower(),
             password=user.password,
         )
 
@@ -172,11 +109,13 @@ def create_user_data(db: Session, user_data: UserSchemas):
         db.close()
 
 
-def create_adverise_controller(db: Session, ad_data: AdvertisementSchema, token=None):
+async def create_adverise_controller(
+    db: AsyncSession, ad_data: AdvertisementSchema, token=None
+):
     try:
 
         user_id = decode_access_token(token=token).get("id")
-        if not db.query(User).filter(User.id == user_id).first():
+        if not await get_principal(db, user_id):
             raise HTTPException(status_code=400, detail=f"Token not Valid...!")
         add_cost_cal = 100 * int(ad_data.ad_run_hours)
         ad_enddate, ad_endtime = calculate_advertise_end_datetime(
@@ -186,108 +125,238 @@ def create_adverise_controller(db: Session, ad_data: AdvertisementSchema, token=
             ad_promot_company_name=ad_data.ad_promot_company_name,
             ad_message=ad_data.ad_message,
             ad_run_hours=ad_data.ad_run_hours,
-            ad_cost=add_cost_cal,
+            ad_cost=str(add_cost_cal),
             is_ad_active=True,
             advertise_end_date=ad_enddate,
             advertise_end_time=ad_endtime,
+            ends_at=datetime.strptime(f"{ad_enddate} {ad_endtime}", "%Y-%m-%d %H:%M"),
             user=user_id,
         )
 
         db.add(new_ad)
-        db.commit()
-        db.refresh(new_ad)
+        await db.flush()
+        version = await bump_ad_index_version(db)
+        await db.commit()
+        active_ads.add(
+            {
+                **AdvertisementSchema.model_validate(new_ad).model_dump(),
+                "ends_at": new_ad.ends_at,
+            },
+            version,
+        )
 
         return new_ad
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=400, detail=f"Error saving advertisement: {str(e)}"
         )
     finally:
-        db.close()
+        await db.close()
 
 
-def create_fact_ad_daily_report(
-    db: Session, user_id=None, likes=None, advertise_id=None
+async def create_fact_ad_daily_report(
+    db: AsyncSession, user_id=None, likes=None, advertise_id=None, client_ip=None
 ):
     try:
-        region_id = get_dim_region(db)
-        date_id = get_dim_dates(db)
-        device_id = get_dim_device_info(db)
-        platform_id = get_dim_platform_info(db)
-        ad_metrics_data = {
-            "advertise_id": advertise_id,
-            "impressions": True,
-            "dim_date_id": date_id.id,
-            "platform_id": platform_id.id,
-            "device_type_id": device_id.id,
-            "region_id": region_id.id,
-            "likes": True if likes else False,
-            "register_user": user_id if user_id else None,
-            "guest_user": get_guest_user(db) if user_id == None else None,
-            "gender_id": (
-                get_or_create_gender(db=db).id
-                if user_id == None
-                else db.query(User).filter(User.id == user_id).first().gender_id
-            ),
-        }
-        ad_matrics = FactAdMetricsDaily(**ad_metrics_data)
-        db.add(ad_matrics)
-        db.commit()
-        db.refresh(ad_matrics)
-
-        return ad_matrics
+        # The ingest service is shared with the sync code paths
+        return await db.run_sync(
+            ingest_event,
+            user_id=user_id,
+            likes=likes,
+            advertise_id=advertise_id,
+            client_ip=client_ip,
+        )
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail=f"Error saving data: {str(e)}")
-    finally:
-        db.close()
 
 
-def fact_ad_daily_report_manage(
-    db: Session, admatrics_data: FactAdMetricsDailySchemas, token=None
+async def fact_ad_daily_report_manage(
+    db: AsyncSession,
+    admatrics_data: FactAdMetricsDailySchemas,
+    token=None,
+    client_ip=None,
 ):
     try:
+        if admatrics_data.advertise_id is not None and not is_valid_id(
+            admatrics_data.advertise_id
+        ):
+            raise HTTPException(status_code=400, detail="Invalid advertise_id")
         if token:
             user_id = decode_access_token(token).get("id")
             fact_ad_register_user = (
-                db.query(FactAdMetricsDaily)
-                .filter(
-                    FactAdMetricsDaily.register_user == user_id,
-                    FactAdMetricsDaily.advertise_id == admatrics_data.advertise_id,
+                await db.scalars(
+                    select(FactAdMetricsDaily)
+                    .where(
+                        FactAdMetricsDaily.register_user == user_id,
+                        FactAdMetricsDaily.advertise_id == admatrics_data.advertise_id,
+                    )
+                    .limit(1)
                 )
-                .first()
-            )
+            ).first()
             if fact_ad_register_user:
-                fact_ad_register_user.likes = admatrics_data.likes
-                db.commit()
+                # By id and date_key, so only the row's partition is probed
+                await db.execute(
+                    update(FactAdMetricsDaily)
+                    .where(
+                        FactAdMetricsDaily.id == fact_ad_register_user.id,
+                        FactAdMetricsDaily.date_key == fact_ad_register_user.date_key,
+                    )
+                    .values(likes=admatrics_data.likes)
+                )
+                await db.commit()
                 update_response_data = FactAdMetricsDailySchemas.model_validate(
                     fact_ad_register_user
                 )
                 return update_response_data
 
             elif admatrics_data.likes or admatrics_data.likes == False:
-                data = create_fact_ad_daily_report(
+                enforce_pacing(admatrics_data.advertise_id, AD_IMPRESSION_PRICE)
+                data = await create_fact_ad_daily_report(
                     user_id=user_id,
                     advertise_id=admatrics_data.advertise_id,
                     likes=admatrics_data.likes,
                     db=db,
+                    client_ip=client_ip,
                 )
                 response_data = FactAdMetricsDailySchemas.model_validate(data)
 
         else:
             if admatrics_data.likes:
                 raise HTTPException(status_code=400, detail="Please Login First...!")
-            data = create_fact_ad_daily_report(
-                advertise_id=admatrics_data.advertise_id, db=db
+            enforce_pacing(admatrics_data.advertise_id, AD_IMPRESSION_PRICE)
+            data = await create_fact_ad_daily_report(
+                advertise_id=admatrics_data.advertise_id, db=db, client_ip=client_ip
             )
             response_data = FactAdMetricsDailySchemas.model_validate(data)
         return response_data
 
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail=f"Error saving data: {str(e)}")
     finally:
-        db.close()
+        await db.close()
+
+
+async def read_batch_payload(request: Request):
+    events = []
+    if "ndjson" in request.headers.get("content-type", ""):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    events.append(parse_batch_line(line))
+            if len(events) > BULK_MAX_EVENTS:
+                break
+        if buffer.strip():
+            events.append(parse_batch_line(buffer))
+    else:
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(payload, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array")
+        events = [{"data": item} for item in payload]
+
+    if len(events) > BULK_MAX_EVENTS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BULK_MAX_EVENTS} events per batch"
+        )
+    return events
+
+
+def parse_batch_line(line: bytes) -> dict:
+    try:
+        return {"data": json.loads(line)}
+    except ValueError as e:
+        return {"error": f"Invalid JSON line: {str(e)}"}
+
+
+async def fact_ad_daily_report_batch_manage(
+    db: AsyncSession, events: list, token=None, client_ip=None
+):
+    try:
+        user_id = decode_access_token(token).get("id") if token else None
+        results = await db.run_sync(
+            ingest_batch, events, user_id=user_id, client_ip=client_ip
+        )
+        statuses = [result["status"] for result in results]
+        return {
+            "created": statuses.count("created"),
+            "updated": statuses.count("updated"),
+            "failed": statuses.count("error"),
+            "paced": statuses.count("paced"),
+            "results": results,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"Error saving data: {str(e)}")
+    finally:
+        await db.close()
+
+
+async def buy_conversion_manage(
+    db: AsyncSession, advertisement_id: str, token=None, client_ip=None
+):
+    if not is_valid_id(advertisement_id):
+        raise HTTPException(status_code=400, detail="Invalid advertisement_id")
+    user_id = decode_access_token(token=token).get("id")
+    today = to_date_key(datetime.now())
+    key = (user_id, advertisement_id, today)
+
+    entry = click_aggregator.get_row(key)
+    if entry is None:
+        fact_ad_matrics_obj = (
+            await db.scalars(
+                select(FactAdMetricsDaily)
+                .where(
+                    FactAdMetricsDaily.register_user == user_id,
+                    FactAdMetricsDaily.advertise_id == advertisement_id,
+                    FactAdMetricsDaily.date_key == today,
+                )
+                .limit(1)
+            )
+        ).first()
+        if not fact_ad_matrics_obj:
+            previous = (
+                await db.execute(
+                    select(FactAdMetricsDaily.likes)
+                    .where(
+                        FactAdMetricsDaily.register_user == user_id,
+                        FactAdMetricsDaily.advertise_id == advertisement_id,
+                    )
+                    .limit(1)
+                )
+            ).first()
+            if not previous:
+                raise HTTPException(status_code=404, detail="Ad metrics not found")
+
+    # Paced before anything is written, so a refused click leaves no fact row
+    enforce_pacing(advertisement_id, AD_CLICK_PRICE)
+    if entry is None:
+        if not fact_ad_matrics_obj:
+            fact_ad_matrics_obj = await create_fact_ad_daily_report(
+                advertise_id=advertisement_id,
+                user_id=user_id,
+                db=db,
+                likes=previous.likes,
+                client_ip=client_ip,
+            )
+        entry = click_aggregator.remember(
+            key,
+            fact_ad_matrics_obj.id,
+            FactAdMetricsDailySchemas.model_validate(fact_ad_matrics_obj).model_dump(),
+        )
+    return await db.run_sync(
+        lambda session: click_aggregator.record_click(key, entry, db=session)
+    )
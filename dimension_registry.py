@@ -0,0 +1,87 @@
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from cache import LRUCache
+from config import DIMENSION_CACHE_SIZE
+from models import (
+    DimDates,
+    DimAgeGroup,
+    DimRegion,
+    DimPlatform,
+    DimDeviceType,
+    DimGender,
+)
+
+# Natural key of every dimension table, backed by a unique index in models.py
+NATURAL_KEYS = {
+    DimRegion: ("regionname", "cityname", "countryname"),
+    DimDates: ("date_created", "time_created"),
+    DimDeviceType: ("device_name",),
+    DimPlatform: ("platform_name", "platform_hostname"),
+    DimAgeGroup: ("age_range",),
+    DimGender: ("gender",),
+}
+
+dimension_cache = LRUCache(maxsize=DIMENSION_CACHE_SIZE)
+
+
+# Unique indexes treat NULLs as distinct, so a missing value is stored as ''
+# and the natural key index still catches two workers inserting it
+def natural_key_values(model, values: dict) -> dict:
+    return {
+        column: "" if values.get(column) is None else values[column]
+        for column in NATURAL_KEYS[model]
+    }
+
+
+def dimension_key(model, values: dict):
+    return (model.__tablename__,) + tuple(
+        values.get(column) for column in NATURAL_KEYS[model]
+    )
+
+
+def get_or_create_dimension(db: Session, model, **values) -> str:
+    values = natural_key_values(model, values)
+    key = dimension_key(model, values)
+    dim_id = dimension_cache.get(key)
+    if dim_id:
+        return dim_id
+
+    # Rows created earlier in the same transaction are only cached once committed
+    pending = db.info.get("pending_dimensions", {})
+    if key in pending:
+        return pending[key]
+
+    record = db.query(model.id).filter_by(**values).first()
+    if record:
+        dimension_cache.set(key, record.id)
+        return record.id
+
+    new_record = model(**values)
+    try:
+        with db.begin_nested():
+            db.add(new_record)
+    except IntegrityError:
+        # Another worker inserted the same natural key first
+        record = db.query(model.id).filter_by(**values).one()
+        dimension_cache.set(key, record.id)
+        return record.id
+
+    db.info.setdefault("pending_dimensions", {})[key] = new_record.id
+    return new_record.id
+
+
+@event.listens_for(Session, "after_commit")
+def _promote_pending_dimensions(session):
+    # Savepoint releases also fire after_commit while the outer transaction is open
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop("pending_dimensions", None)
+    for key, dim_id in (pending or {}).items():
+        dimension_cache.set(key, dim_id)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_pending_dimensions(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("pending_dimensions", None)
@@ -1,24 +1,11 @@
 import platform
 import subprocess
-import requests
 import getpass
 import socket
 import os
-
-
-def get_ip_info():
-    try:
-        response = requests.get("https://ipinfo.io/json")
-        data = response.json()
-        return {
-            "region": data.get("region"),
-            "location": data.get("loc"),
-            "city": data.get("city"),
-            "country": data.get("country"),
-            "ip": data.get("ip"),
-        }
-    except Exception as e:
-        return {"error": str(e)}
+from functools import lru_cache
+from geo_resolver import resolve_ip
+from request_metrics import timed_lookup
 
 
 def get_device_type():
@@ -105,9 +92,16 @@ def get_device_info():
     }
 
 
-def get_current_info():
-    ip_info = get_ip_info()
-    device_info = get_device_info()
+# Host and device facts never change for the lifetime of the process
+@lru_cache(maxsize=None)
+def get_host_info():
+    return get_device_info()
+
+
+@timed_lookup("get_current_info")
+def get_current_info(ip=None):
+    ip_info = resolve_ip(ip)
+    device_info = get_host_info()
 
     result = {
         "region": ip_info.get("region"),
@@ -117,7 +111,7 @@ def get_current_info():
         "device_company": device_info.get("company"),
         "platform": device_info.get("platform"),
         "platform_hostname": device_info.get("placement"),
-        "location": ip_info.get("loc"),
+        "location": ip_info.get("location"),
         "name": device_info.get("username"),
         "ip": ip_info.get("ip"),
     }
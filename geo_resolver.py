@@ -0,0 +1,161 @@
+from abc import ABC, abstractmethod
+import csv
+import ipaddress
+import logging
+from typing import Optional
+from fastapi import Request
+from cache import LRUCache
+from config import (
+    GEOIP_DATABASE_PATH,
+    GEO_CIDR_TABLE_PATH,
+    GEO_CACHE_SIZE,
+    GEO_CACHE_TTL_SECONDS,
+    TRUST_FORWARDED_FOR,
+)
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+logger = logging.getLogger(__name__)
+
+
+def empty_location(ip: Optional[str] = None) -> dict:
+    return {"region": None, "city": None, "country": None, "location": None, "ip": ip}
+
+
+class GeoResolver(ABC):
+    @abstractmethod
+    def resolve(self, ip: str) -> Optional[dict]:
+        pass
+
+
+# CSV file with a header of network,region,city,country,location
+class CIDRTableResolver(GeoResolver):
+    def __init__(self, path: str):
+        # {(ip version, prefix length): {network address as int: location}}
+        self.networks = {}
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                network = ipaddress.ip_network(row["network"].strip(), strict=False)
+                bucket = self.networks.setdefault(
+                    (network.version, network.prefixlen), {}
+                )
+                bucket[int(network.network_address)] = {
+                    "region": row.get("region") or None,
+                    "city": row.get("city") or None,
+                    "country": row.get("country") or None,
+                    "location": row.get("location") or None,
+                }
+        # Most specific prefixes are tried first
+        self.prefixes = sorted(self.networks, key=lambda key: -key[1])
+
+    def resolve(self, ip: str) -> Optional[dict]:
+        address = ipaddress.ip_address(ip)
+        bits = address.max_prefixlen
+        value = int(address)
+        for version, prefixlen in self.prefixes:
+            if version != address.version:
+                continue
+            mask = ((1 << prefixlen) - 1) << (bits - prefixlen)
+            location = self.networks[(version, prefixlen)].get(value & mask)
+            if location:
+                return location
+        return None
+
+
+# Local MaxMind GeoIP2/GeoLite2 City database, needs the optional maxminddb package
+class GeoIPDatabaseResolver(GeoResolver):
+    def __init__(self, path: str):
+        if maxminddb is None:
+            raise RuntimeError("maxminddb is required to read GEOIP_DATABASE_PATH")
+        self.reader = maxminddb.open_database(path)
+
+    def resolve(self, ip: str) -> Optional[dict]:
+        record = self.reader.get(ip)
+        if not record:
+            return None
+        subdivisions = record.get("subdivisions") or [{}]
+        location = record.get("location") or {}
+        return {
+            "region": subdivisions[0].get("names", {}).get("en"),
+            "city": record.get("city", {}).get("names", {}).get("en"),
+            "country": record.get("country", {}).get("iso_code"),
+            "location": (
+                f"{location['latitude']},{location['longitude']}"
+                if "latitude" in location and "longitude" in location
+                else None
+            ),
+        }
+
+
+class ChainResolver(GeoResolver):
+    def __init__(self, resolvers):
+        self.resolvers = resolvers
+
+    def resolve(self, ip: str) -> Optional[dict]:
+        for resolver in self.resolvers:
+            location = resolver.resolve(ip)
+            if location:
+                return location
+        return None
+
+
+class CachedResolver(GeoResolver):
+    def __init__(self, resolver: GeoResolver, cache: LRUCache):
+        self.resolver = resolver
+        self.cache = cache
+
+    def resolve(self, ip: Optional[str]) -> dict:
+        if not ip:
+            return empty_location()
+        location = self.cache.get(ip)
+        if location is not None:
+            return location
+        try:
+            address = ipaddress.ip_address(ip)
+            found = None
+            if address.is_global:
+                found = self.resolver.resolve(ip)
+        except ValueError:
+            found = None
+        except Exception as e:
+            logger.warning(f"Geo lookup failed for {ip}: {e}")
+            found = None
+        location = {**empty_location(ip), **(found or {}), "ip": ip}
+        self.cache.set(ip, location)
+        return location
+
+
+def build_resolver() -> CachedResolver:
+    resolvers = []
+    if GEOIP_DATABASE_PATH:
+        try:
+            resolvers.append(GeoIPDatabaseResolver(GEOIP_DATABASE_PATH))
+        except Exception as e:
+            logger.warning(f"GeoIP database disabled: {e}")
+    if GEO_CIDR_TABLE_PATH:
+        try:
+            resolvers.append(CIDRTableResolver(GEO_CIDR_TABLE_PATH))
+        except Exception as e:
+            logger.warning(f"CIDR range table disabled: {e}")
+    return CachedResolver(
+        ChainResolver(resolvers),
+        LRUCache(maxsize=GEO_CACHE_SIZE, ttl=GEO_CACHE_TTL_SECONDS),
+    )
+
+
+geo_resolver = build_resolver()
+
+
+def resolve_ip(ip: Optional[str]) -> dict:
+    return geo_resolver.resolve(ip)
+
+
+def get_client_ip(request: Request) -> Optional[str]:
+    if TRUST_FORWARDED_FOR:
+        forwarded_for = request.headers.get("x-forwarded-for")
+        if forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+    return request.client.host if request.client else None
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+from config import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS
+
+
+# Single bcrypt policy for the whole app. Hashes made with any other cost
+# factor are reported as needing an update so they get rehashed on login.
+# bcrypt releases the GIL while hashing, so a thread pool keeps the event
+# loop free and caps how many hashes run at once.
+class PasswordHasher:
+    def __init__(
+        self, rounds: int = BCRYPT_ROUNDS, workers: int = PASSWORD_HASH_WORKERS
+    ):
+        self.context = CryptContext(
+            schemes=["bcrypt"],
+            deprecated="auto",
+            bcrypt__default_rounds=rounds,
+            bcrypt__min_rounds=rounds,
+            bcrypt__max_rounds=rounds,
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password-hasher"
+        )
+        self.workers = workers
+        self.rounds = rounds
+        self.queued = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def _done(self, future):
+        with self._lock:
+            self.queued -= 1
+            self.completed += 1
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            self.queued += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def hash(self, password: str) -> str:
+        return self._submit(self.context.hash, password).result()
+
+    def verify_and_update(
+        self, password: str, hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+        return self._submit(
+            self.context.verify_and_update, password, hashed_password
+        ).result()
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(self.context.hash, password))
+
+    async def verify_and_update_async(
+        self, password: str, hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(
+            self._submit(self.context.verify_and_update, password, hashed_password)
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rounds": self.rounds,
+                "workers": self.workers,
+                # Submitted but not finished, including the ones still waiting
+                "queue_depth": self.queued,
+                "completed": self.completed,
+            }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import uuid
+from sqlalchemy import String, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import TypeDecorator
+from config import PRIMARY_KEY_TYPE
+
+logger = logging.getLogger(__name__)
+
+
+# RFC 9562 UUIDv7: a 48-bit millisecond timestamp followed by random bits, so
+# new keys sort by creation time and inserts land at the right edge of the
+# B-tree instead of scattering across it. Also true of the text form.
+def uuid7() -> uuid.UUID:
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = value & ~(0xF << 76) | 0x7 << 76
+    value = value & ~(0x3 << 62) | 0x2 << 62
+    return uuid.UUID(int=value)
+
+
+def new_id() -> str:
+    return str(uuid7())
+
+
+# Key column type. Python always sees the canonical string form, so schemas,
+# tokens and caches are unchanged; with PRIMARY_KEY_TYPE=uuid, PostgreSQL
+# stores it as a native 16-byte uuid instead of 36 bytes of text.
+class GUID(TypeDecorator):
+    impl = String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql" and PRIMARY_KEY_TYPE == "uuid":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(String())
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else str(value)
+
+
+def is_valid_id(value: str) -> bool:
+    if not isinstance(value, str):
+        return False
+    if PRIMARY_KEY_TYPE != "uuid":
+        return True
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+def uuid_key_columns(metadata) -> dict:
+    return {
+        table.name: [
+            column.name for column in table.columns if isinstance(column.type, GUID)
+        ]
+        for table in metadata.sorted_tables
+        if any(isinstance(column.type, GUID) for column in table.columns)
+    }
+
+
+# Migration path for PRIMARY_KEY_TYPE=uuid: rewrites every varchar key and
+# foreign key column as uuid in one transaction. Foreign keys between them are
+# dropped first and recreated afterwards, since both ends must change together.
+# Once converted this is a catalog lookup, so it runs on every start.
+def ensure_uuid_keys(engine: Engine, metadata):
+    if PRIMARY_KEY_TYPE != "uuid" or engine.dialect.name != "postgresql":
+        return
+    key_columns = uuid_key_columns(metadata)
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('uuid_keys'))"))
+        pending = {}
+        for table, columns in key_columns.items():
+            types = dict(
+                conn.execute(
+                    text(
+                        "SELECT column_name, data_type FROM information_schema.columns "
+                        "WHERE table_schema = current_schema() AND table_name = :table"
+                    ),
+                    {"table": table},
+                ).all()
+            )
+            pending[table] = [c for c in columns if types.get(c, "uuid") != "uuid"]
+        pending = {table: columns for table, columns in pending.items() if columns}
+        if not pending:
+            return
+
+        quote = conn.dialect.identifier_preparer.quote
+        foreign_keys = conn.execute(
+            text(
+                "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+                "FROM pg_constraint WHERE contype = 'f' AND conparentid = 0 "
+                "AND (conrelid::regclass::text = ANY(:tables) "
+                "OR confrelid::regclass::text = ANY(:tables))"
+            ),
+            {"tables": [quote(table) for table in key_columns]},
+        ).all()
+        for table, name, _ in foreign_keys:
+            conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {quote(name)}"))
+        for table, columns in pending.items():
+            conn.execute(
+                text(
+                    f"ALTER TABLE {quote(table)} "
+                    + ", ".join(
+                        f"ALTER COLUMN {quote(c)} TYPE uuid USING NULLIF({quote(c)}, '')::uuid"
+                        for c in columns
+                    )
+                )
+            )
+        for table, name, definition in foreign_keys:
+            conn.execute(
+                text(f"ALTER TABLE {table} ADD CONSTRAINT {quote(name)} {definition}")
+            )
+        logger.info(f"Converted key columns to uuid: {pending}")
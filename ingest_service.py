@@ -0,0 +1,294 @@
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+from sqlalchemy.util import await_only
+from typing import Optional, List
+from datetime import datetime
+import csv
+import io
+from identifiers import new_id, is_valid_id
+from models import (
+    DimDates,
+    DimRegion,
+    DimPlatform,
+    DimDeviceType,
+    DimGender,
+    User,
+    FactAdMetricsDaily,
+    Guestuser,
+    Advertisement,
+)
+from schemas import FactAdMetricsDailySchemas
+from config import BULK_COPY_THRESHOLD, AD_IMPRESSION_PRICE
+from dimension_registry import get_or_create_dimension
+from calendar_dimension import to_date_key
+from generate_system_report import get_current_info
+from authentication import get_principal_sync
+from reach import reach_sketches
+from pacing import pacer
+
+
+def get_dim_dates(db: Session, now: Optional[datetime] = None) -> str:
+    now = now or datetime.now()
+    return get_or_create_dimension(
+        db,
+        DimDates,
+        date_created=now.strftime("%Y-%m-%d"),
+        time_created=now.strftime("%H:%M"),
+    )
+
+
+def get_dim_region(db: Session, current_info: dict) -> str:
+    return get_or_create_dimension(
+        db,
+        DimRegion,
+        regionname=current_info["region"],
+        cityname=current_info["city"],
+        countryname=current_info["country"],
+    )
+
+
+def get_dim_device_info(db: Session, current_info: dict) -> str:
+    return get_or_create_dimension(
+        db,
+        DimDeviceType,
+        device_name=f"{current_info['device_company']} {current_info['device_type']}",
+    )
+
+
+def get_dim_platform_info(db: Session, current_info: dict) -> str:
+    return get_or_create_dimension(
+        db,
+        DimPlatform,
+        platform_name=current_info["platform"],
+        platform_hostname=current_info["platform_hostname"],
+    )
+
+
+def guest_user_values(current_info: dict) -> dict:
+    # The id is generated here so the fact row can reference it without a RETURNING
+    return {
+        "id": new_id(),
+        "ip_address": current_info["ip"],
+        "guest_name": current_info["name"],
+        "location": current_info["location"],
+    }
+
+
+def build_fact_values(
+    db: Session, current_info: dict, user_id=None, likes=None, advertise_id=None
+) -> dict:
+    principal = get_principal_sync(db, user_id) if user_id else None
+    now = datetime.now()
+    return {
+        "advertise_id": advertise_id,
+        "impressions": True,
+        "dim_date_id": get_dim_dates(db, now),
+        "date_key": to_date_key(now),
+        "hour": now.hour,
+        "platform_id": get_dim_platform_info(db, current_info),
+        "device_type_id": get_dim_device_info(db, current_info),
+        "region_id": get_dim_region(db, current_info),
+        "likes": True if likes else False,
+        "register_user": user_id if user_id else None,
+        "guest_user": None,
+        "gender_id": (
+            get_or_create_dimension(db, DimGender, gender="unknown")
+            if user_id == None
+            else principal and principal["gender_id"]
+        ),
+    }
+
+
+# Writes one impression as a single unit of work: dimension lookups are served
+# from the registry cache, the guest user and fact row are plain INSERTs and the
+# fact comes back through RETURNING, followed by one commit.
+def ingest_event(
+    db: Session, user_id=None, likes=None, advertise_id=None, client_ip=None
+) -> FactAdMetricsDaily:
+    current_info = get_current_info(client_ip)
+    values = build_fact_values(
+        db, current_info, user_id=user_id, likes=likes, advertise_id=advertise_id
+    )
+    if user_id == None:
+        guest = guest_user_values(current_info)
+        db.execute(insert(Guestuser), [guest])
+        values["guest_user"] = guest["id"]
+
+    ad_matrics = db.scalars(
+        insert(FactAdMetricsDaily).returning(FactAdMetricsDaily), [values]
+    ).one()
+    db.commit()
+    reach_sketches.add(values, guest_ip=current_info["ip"])
+    return ad_matrics
+
+
+def copy_rows_psycopg2(db: Session, table, rows: List[dict]):
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if row[c] is None else row[c] for c in columns])
+    buffer.seek(0)
+    cursor = db.connection().connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN "
+            "WITH (FORMAT csv, NULL '\\N')",
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+# The AsyncSession path: binary COPY on the asyncpg connection, awaited from
+# the greenlet run_sync executes in
+def copy_rows_asyncpg(db: Session, table, rows: List[dict]):
+    columns = list(rows[0].keys())
+    driver_connection = db.connection().connection.driver_connection
+    await_only(
+        driver_connection.copy_records_to_table(
+            table.name,
+            records=[tuple(row[c] for c in columns) for row in rows],
+            columns=columns,
+        )
+    )
+
+
+# COPY goes through driver specific APIs; PostgreSQL drivers missing here
+# still work, through the multi-row INSERT
+COPY_DRIVERS = {
+    "psycopg2": copy_rows_psycopg2,
+    "asyncpg": copy_rows_asyncpg,
+}
+
+
+def insert_fact_rows(db: Session, rows: List[dict]):
+    if not rows:
+        return
+    dialect = db.get_bind().dialect
+    copy_rows = COPY_DRIVERS.get(dialect.driver)
+    if (
+        dialect.name == "postgresql"
+        and copy_rows is not None
+        and len(rows) >= BULK_COPY_THRESHOLD
+    ):
+        copy_rows(db, FactAdMetricsDaily.__table__, rows)
+    else:
+        # executemany is batched into multi-row INSERT ... VALUES by SQLAlchemy
+        db.execute(insert(FactAdMetricsDaily), rows)
+
+
+# Writes a whole batch of events from one client in one transaction. Dimensions
+# and the user lookup are resolved once for the batch, existing (user, ad) rows
+# are fetched with one IN query, and new facts go out as one bulk insert.
+def ingest_batch(
+    db: Session, events: List[dict], user_id=None, client_ip=None
+) -> List[dict]:
+    results = [None] * len(events)
+    valid = []
+    for index, event in enumerate(events):
+        if "error" in event:
+            results[index] = {
+                "index": index,
+                "status": "error",
+                "detail": event["error"],
+            }
+            continue
+        try:
+            data = FactAdMetricsDailySchemas.model_validate(event["data"])
+        except Exception as e:
+            results[index] = {"index": index, "status": "error", "detail": str(e)}
+            continue
+        if data.likes and not user_id:
+            results[index] = {
+                "index": index,
+                "status": "error",
+                "detail": "Please Login First...!",
+            }
+            continue
+        valid.append((index, data))
+
+    advertise_ids = {
+        data.advertise_id for _, data in valid if is_valid_id(data.advertise_id)
+    }
+    known_ads = set()
+    if advertise_ids:
+        known_ads = {
+            ad_id
+            for (ad_id,) in db.query(Advertisement.id).filter(
+                Advertisement.id.in_(advertise_ids)
+            )
+        }
+
+    existing = {}
+    if user_id and known_ads:
+        for fact_id, advertise_id in db.query(
+            FactAdMetricsDaily.id, FactAdMetricsDaily.advertise_id
+        ).filter(
+            FactAdMetricsDaily.register_user == user_id,
+            FactAdMetricsDaily.advertise_id.in_(known_ads),
+        ):
+            existing.setdefault(advertise_id, fact_id)
+
+    current_info = get_current_info(client_ip)
+    template = None
+    new_rows = {}
+    fact_rows = []
+    updates = {}
+    for index, data in valid:
+        if data.advertise_id not in known_ads:
+            results[index] = {
+                "index": index,
+                "status": "error",
+                "detail": "Advertisement not found",
+            }
+            continue
+
+        if user_id and data.advertise_id in existing:
+            fact_id = existing[data.advertise_id]
+            updates[fact_id] = data.likes
+            results[index] = {"index": index, "status": "updated", "id": fact_id}
+            continue
+        if user_id and data.advertise_id in new_rows:
+            row = new_rows[data.advertise_id]
+            row["likes"] = True if data.likes else False
+            results[index] = {"index": index, "status": "updated", "id": row["id"]}
+            continue
+        # Every new impression spends budget, so batches are paced per item
+        if not pacer.allow(data.advertise_id, AD_IMPRESSION_PRICE):
+            results[index] = {
+                "index": index,
+                "status": "paced",
+                "detail": "Advertisement is ahead of its budget pace, try again later",
+            }
+            continue
+
+        if template is None:
+            template = build_fact_values(db, current_info, user_id=user_id)
+            if user_id == None:
+                guest = guest_user_values(current_info)
+                db.execute(insert(Guestuser), [guest])
+                template["guest_user"] = guest["id"]
+        row = {
+            **template,
+            "id": new_id(),
+            "advertise_id": data.advertise_id,
+            "likes": True if data.likes else False,
+            "clicks": 0,
+            "conversions": False,
+        }
+        fact_rows.append(row)
+        if user_id:
+            new_rows[data.advertise_id] = row
+        results[index] = {"index": index, "status": "created", "id": row["id"]}
+
+    insert_fact_rows(db, fact_rows)
+    if updates:
+        db.execute(
+            update(FactAdMetricsDaily),
+            [{"id": fact_id, "likes": likes} for fact_id, likes in updates.items()],
+        )
+    db.commit()
+    for row in fact_rows:
+        reach_sketches.add(row, guest_ip=current_info["ip"])
+    return results
@@ -1,15 +1,27 @@
 from fastapi import FastAPI, status, Request, Depends, Header, Query
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import (
+    JSONResponse,
+    HTMLResponse,
+    StreamingResponse,
+    PlainTextResponse,
+)
 from database_connection import Base, engine
 from fastapi.security import OAuth2PasswordRequestForm
 import json, os
 
 from fastapi.middleware.cors import CORSMiddleware
-from config import MIDDLEWARE_KEY, ACCESS_TOKEN_EXPIRE_MINUTES
+from config import (
+    MIDDLEWARE_KEY,
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    METRICS_PAGE_SIZE,
+    METRICS_MAX_PAGE_SIZE,
+)
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi import BackgroundTasks, Form
-from database_connection import Base, get_db
+from database_connection import Base, get_db, get_async_db, async_engine
 from models import *
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from schemas import (
     UserLogin,
@@ -17,15 +29,28 @@ from schemas import (
     Token,
     FactAdMetricsDailySchemas,
     AdvertisementSchema,
+    BatchIngestResponse,
+    MetricsAggregate,
+    FactMetricsFilters,
+    ReachEstimate,
 )
 import uvicorn
 from scheduler import setup_scheduler, scheduler
+from click_aggregator import flush_click_aggregator
+from rollup import rollup_status
+from pool_stats import get_pool_stats
+from request_metrics import RequestMetricsMiddleware, metrics
+from query_profiler import slow_query_log
+from hasher import password_hasher
 from typing import Optional, List
 from controllers import (
     create_user_data,
     fact_ad_daily_report_manage,
     create_adverise_controller,
     create_fact_ad_daily_report,
+    fact_ad_daily_report_batch_manage,
+    read_batch_payload,
+    buy_conversion_manage,
 )
 from datetime import timedelta
 from authentication import (
@@ -33,10 +58,46 @@ from authentication import (
     authenticate_user,
     oauth2_scheme,
     decode_access_token,
+    require_login,
+    require_superadmin,
 )
 from fastapi import HTTPException, status
+from migrations import run_migrations
+from calendar_dimension import ensure_calendar
+from identifiers import ensure_uuid_keys
+from partitioning import ensure_partitioning, partitioning_enabled, partition_status
+from ad_index import load_ad_index, active_ads
+from ad_accounting import ad_expiry_status
+from pacing import pacer
+from reach import (
+    reach_estimates,
+    parse_reach_advertise_id,
+    parse_reach_dimension,
+    flush_reach_sketches,
+)
+from geo_resolver import get_client_ip
+from generate_system_report import get_host_info
+from reporting import (
+    fact_metrics_filters,
+    authorize_user_filter,
+    fact_metrics_query,
+    fact_metrics_page,
+    stream_fact_metrics,
+    parse_group_by,
+    aggregate_query,
+    aggregate_fact_metrics,
+    validate_date_param,
+    filter_values,
+    AGGREGATE_DIMENSIONS,
+)
 
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
+ensure_uuid_keys(engine, Base.metadata)
+ensure_calendar(engine)
+ensure_partitioning(engine)
+load_ad_index(engine)
+pacer.restore(engine)
 app = FastAPI()
 
 app.add_middleware(
@@ -45,10 +106,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["content-type", "authorization", "advertisement_id", "token"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.add_middleware(SessionMiddleware, secret_key=MIDDLEWARE_KEY)
 
+app.add_middleware(RequestMetricsMiddleware)
+
 
 @app.post("/users/", response_model=UserSchemas)
 def create_user(user_data: UserSchemas, db: Session = Depends(get_db)):
@@ -65,20 +129,51 @@ def create_user(user_data: UserSchemas, db: Session = Depends(get_db)):
 async def create_advertise(
     ad_data: AdvertisementSchema,
     token: Optional[str] = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    response_data = create_adverise_controller(db=db, ad_data=ad_data, token=token)
+    response_data = await create_adverise_controller(
+        db=db, ad_data=ad_data, token=token
+    )
     return response_data
 
 
+# Picks a live advertisement from this worker's in-memory index
+@app.get("/serve-ad/", response_model=AdvertisementSchema)
+async def serve_ad():
+    ad = active_ads.choose()
+    if ad is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No active advertisement"
+        )
+    return ad
+
+
 @app.post("/create/fact-ad-matrics/", response_model=FactAdMetricsDailySchemas)
 async def fact_ad_matrics_manage(
     admatrics_data: FactAdMetricsDailySchemas,
+    request: Request,
+    token: Optional[str] = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    response_data = await fact_ad_daily_report_manage(
+        db=db,
+        admatrics_data=admatrics_data,
+        token=token,
+        client_ip=get_client_ip(request),
+    )
+    return response_data
+
+
+# Accepts a JSON array of events, or one event per line with Content-Type: application/x-ndjson
+@app.post("/create/fact-ad-matrics/batch/", response_model=BatchIngestResponse)
+async def fact_ad_matrics_batch_manage(
+    request: Request,
     token: Optional[str] = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    response_data = fact_ad_daily_report_manage(
-        db=db, admatrics_data=admatrics_data, token=token
+    events = await read_batch_payload(request)
+    response_data = await fact_ad_daily_report_batch_manage(
+        db=db, events=events, token=token, client_ip=get_client_ip(request)
     )
     return response_data
 
@@ -86,8 +181,9 @@ async def fact_ad_matrics_manage(
 # This is a example of buy URL  accessible only to registered users. Each visit counts as a conversion and increments the click count by one
 @app.get("/")
 async def buy_conversions(
+    request: Request,
     token: Optional[str] = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     advertisement_id: Optional[str] = Header(..., alias="advertisement_id"),
 ):
     if not token:
@@ -97,61 +193,18 @@ async def buy_conversions(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    user_id = decode_access_token(token=token).get("id")
-    fact_ad_matrics_obj = (
-        db.query(FactAdMetricsDaily)
-        .filter(
-            FactAdMetricsDaily.register_user == user_id,
-            FactAdMetricsDaily.advertise_id == advertisement_id,
-        )
-        .first()
-    )
-    if not fact_ad_matrics_obj:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Ad metrics not found"
-        )
-
-    dates = (
-        db.query(DimDates)
-        .filter(DimDates.id == fact_ad_matrics_obj.dim_date_id)
-        .first()
-    )
-    if not dates:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Date not found"
-        )
-
-    if dates.date_created != datetime.now().strftime("%Y-%m-%d"):
-        fact_ad_matrics_new_obj = create_fact_ad_daily_report(
-            advertise_id=advertisement_id,
-            user_id=user_id,
-            db=db,
-            likes=fact_ad_matrics_obj.likes,
-        )
-        fact_ad_matrics_new_obj.conversions = True
-        fact_ad_matrics_new_obj.clicks = int(fact_ad_matrics_new_obj.clicks) + 1
-        db.commit()
-        response_data = FactAdMetricsDailySchemas.model_validate(
-            fact_ad_matrics_new_obj
-        )
-    elif not fact_ad_matrics_obj.conversions:
-        fact_ad_matrics_obj.conversions = True
-        fact_ad_matrics_obj.clicks = int(fact_ad_matrics_obj.clicks) + 1
-        db.commit()
-        response_data = FactAdMetricsDailySchemas.model_validate(fact_ad_matrics_obj)
-    else:
-        fact_ad_matrics_obj.clicks = int(fact_ad_matrics_obj.clicks) + 1
-        db.commit()
-        response_data = FactAdMetricsDailySchemas.model_validate(fact_ad_matrics_obj)
-
-    return JSONResponse(
-        status_code=status.HTTP_200_OK, content={"data": response_data.model_dump()}
+    response_data = await buy_conversion_manage(
+        db=db,
+        advertisement_id=advertisement_id,
+        token=token,
+        client_ip=get_client_ip(request),
     )
+    return JSONResponse(status_code=status.HTTP_200_OK, content={"data": response_data})
 
 
 @app.post("/login-user/", response_model=Token)
-async def login(form_data: UserLogin, db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.email, form_data.password)
+async def login(form_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user(db, form_data.email, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -166,91 +219,150 @@ async def login(form_data: UserLogin, db: Session = Depends(get_db)):
 
 
 @app.get("/cron-status")
-async def get_cron_status():
+async def get_cron_status(db: AsyncSession = Depends(get_async_db)):
     try:
-        job = scheduler.get_job("log_timestamp_job")
+        job = scheduler.get_job("rollup_refresh_job")
         if job:
             return {
                 "status": "running",
                 "next_run": str(job.next_run_time),
                 "job_id": job.id,
+                "rollup": await rollup_status(db),
+                "ad_expiry": ad_expiry_status,
+                **(
+                    {"partitions": partition_status}
+                    if partitioning_enabled(engine)
+                    else {}
+                ),
             }
         return {"status": "not_found"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
+@app.get("/internal/pool-stats")
+async def pool_stats(
+    token: Optional[str] = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    await require_superadmin(db, token)
+    return {**get_pool_stats(), "password_hasher": password_hasher.stats()}
+
+
+# Statements are logged with their bind parameters, so superadmins only
+@app.get("/internal/slow-queries")
+async def slow_queries(
+    limit: Optional[int] = Query(None, ge=1),
+    token: Optional[str] = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    await require_superadmin(db, token)
+    return slow_query_log.snapshot(limit)
+
+
+@app.delete("/internal/slow-queries")
+async def clear_slow_queries(
+    token: Optional[str] = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    await require_superadmin(db, token)
+    slow_query_log.clear()
+    return {"cleared": True}
+
+
+# Prometheus text exposition format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/fact-ad-metrics/", response_model=List[FactAdMetricsDailySchemas])
 async def get_fact_ad_metrics(
-    start_date: Optional[str] = Query(None),
-    end_date: Optional[str] = Query(None),
-    region_id: Optional[str] = Query(None),
-    platform_id: Optional[str] = Query(None),
-    device_type_id: Optional[str] = Query(None),
-    gender_id: Optional[str] = Query(None),
+    filters: FactMetricsFilters = Depends(fact_metrics_filters),
+    limit: int = Query(METRICS_PAGE_SIZE, ge=1, le=METRICS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
     token: Optional[str] = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
+    caller = require_login(token)
+    await authorize_user_filter(db, filters, caller.get("id"))
+    query = fact_metrics_query(filters)
 
-    if not token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Please Login First...!",
-            headers={"WWW-Authenticate": "Bearer"},
+    if format == "ndjson":
+        return StreamingResponse(
+            stream_fact_metrics(query, cursor), media_type="application/x-ndjson"
         )
 
-    if start_date:
-        try:
-            datetime.strptime(start_date, "%Y-%m-%d")
-        except ValueError:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="start_date must be in YYYY-MM-DD format",
-            )
-    if end_date:
-        try:
-            datetime.strptime(end_date, "%Y-%m-%d")
-        except ValueError:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="end_date must be in YYYY-MM-DD format",
-            )
-
-    query = db.query(FactAdMetricsDaily)
-
-    if start_date or end_date:
-        query = query.join(DimDates, FactAdMetricsDaily.dim_date_id == DimDates.id)
-        if start_date:
-            query = query.filter(DimDates.date_created >= start_date)
-        if end_date:
-            query = query.filter(DimDates.date_created <= end_date)
-
-    elif region_id:
-        query = query.filter(FactAdMetricsDaily.region_id == region_id)
-    elif platform_id:
-        query = query.filter(FactAdMetricsDaily.platform_id == platform_id)
-    elif device_type_id:
-        query = query.filter(FactAdMetricsDaily.device_type_id == device_type_id)
-    elif gender_id:
-        query = query.filter(FactAdMetricsDaily.gender_id == gender_id)
-
-    results = query.all()
-    if not results:
-        return []
-
-    response_data = [
-        FactAdMetricsDailySchemas.model_validate(result) for result in results
-    ]
-    return response_data
+    response_data, next_cursor = await fact_metrics_page(db, query, limit, cursor)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return JSONResponse(content=response_data, headers=headers)
+
+
+@app.get(
+    "/fact-ad-metrics/aggregate/",
+    response_model=List[MetricsAggregate],
+    response_model_exclude_none=True,
+)
+async def get_fact_ad_metrics_aggregate(
+    group_by: Optional[str] = Query(
+        None, description="Comma separated: " + ",".join(AGGREGATE_DIMENSIONS)
+    ),
+    filters: FactMetricsFilters = Depends(fact_metrics_filters),
+    source: str = Query("rollup", pattern="^(rollup|raw)$"),
+    token: Optional[str] = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    caller = require_login(token)
+    await authorize_user_filter(db, filters, caller.get("id"))
+    query = aggregate_query(parse_group_by(group_by), filters, source)
+    return await aggregate_fact_metrics(db, query)
+
+
+# Approximate distinct users and guests who saw an ad, from HyperLogLog
+# sketches instead of a COUNT(DISTINCT) over the fact table
+@app.get(
+    "/fact-ad-metrics/reach/",
+    response_model=List[ReachEstimate],
+    response_model_exclude_none=True,
+)
+async def get_fact_ad_reach(
+    advertise_id: str = Query(...),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    dimension: Optional[str] = Query(
+        None, description="One of: region, platform, device_type, gender"
+    ),
+    dimension_value: Optional[List[str]] = Query(None),
+    token: Optional[str] = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    require_login(token)
+    validate_date_param("start_date", start_date)
+    validate_date_param("end_date", end_date)
+    return await reach_estimates(
+        db,
+        parse_reach_advertise_id(advertise_id),
+        dimension=parse_reach_dimension(dimension),
+        values=filter_values("dimension_value", dimension_value),
+        start_date=start_date,
+        end_date=end_date,
+    )
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     scheduler.shutdown()
+    flush_click_aggregator()
+    flush_reach_sketches()
+    await async_engine.dispose()
 
 
 @app.on_event("startup")
 async def on_event():
+    get_host_info()
     setup_scheduler()
 
 
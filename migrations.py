@@ -0,0 +1,330 @@
+from datetime import datetime
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from reach import backfill_reach_sketches
+
+logger = logging.getLogger(__name__)
+
+# Dimension tables, their natural key and the columns that reference them
+DIMENSION_TABLES = {
+    "dimregion": (
+        ("regionname", "cityname", "countryname"),
+        [("fact_admetrics_daily", "region_id")],
+    ),
+    "dimdates": (
+        ("date_created", "time_created"),
+        [("fact_admetrics_daily", "dim_date_id")],
+    ),
+    "dimdevicetype": (
+        ("device_name",),
+        [("fact_admetrics_daily", "device_type_id")],
+    ),
+    "dimplatform": (
+        ("platform_name", "platform_hostname"),
+        [("fact_admetrics_daily", "platform_id")],
+    ),
+    "dimagegroup": (
+        ("age_range",),
+        [("user", "agegroup_id")],
+    ),
+    "dimgender": (
+        ("gender",),
+        [("user", "gender_id"), ("fact_admetrics_daily", "gender_id")],
+    ),
+}
+
+
+def _quote(conn: Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _null_safe_equals(conn: Connection) -> str:
+    return "IS" if conn.dialect.name == "sqlite" else "IS NOT DISTINCT FROM"
+
+
+# Missing natural key values become '', as the registry stores them, since a
+# unique index never matches NULLs. The index is dropped first so rows that
+# only differ by NULL versus '' can be merged before it is built again.
+def deduplicate_dimensions(conn: Connection):
+    equals = _null_safe_equals(conn)
+    for table, (natural_key, references) in DIMENSION_TABLES.items():
+        conn.execute(text(f"DROP INDEX IF EXISTS uq_{table}_natural_key"))
+        for column in natural_key:
+            conn.execute(
+                text(f"UPDATE {table} SET {column} = '' WHERE {column} IS NULL")
+            )
+        match = " AND ".join(f"d1.{c} {equals} d2.{c}" for c in natural_key)
+        group_by = ", ".join(natural_key)
+        # Ids are compared as text, since uuid keys have no MIN()
+        if conn.execute(text(f"SELECT 1 FROM {table} LIMIT 1")).first() is not None:
+            for ref_table, ref_column in references:
+                ref = _quote(conn, ref_table)
+                conn.execute(
+                    text(
+                        f"UPDATE {ref} SET {ref_column} = ("
+                        f"SELECT d2.id FROM {table} d1 JOIN {table} d2 ON {match} "
+                        f"WHERE d1.id = {ref}.{ref_column} "
+                        f"ORDER BY CAST(d2.id AS VARCHAR) LIMIT 1) "
+                        f"WHERE {ref_column} IS NOT NULL"
+                    )
+                )
+            conn.execute(
+                text(
+                    f"DELETE FROM {table} WHERE CAST(id AS VARCHAR) NOT IN ("
+                    f"SELECT MIN(CAST(id AS VARCHAR)) FROM {table} GROUP BY {group_by})"
+                )
+            )
+        conn.execute(
+            text(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_natural_key "
+                f"ON {table} ({', '.join(natural_key)})"
+            )
+        )
+
+
+def integer_clicks(conn: Connection):
+    columns = {c["name"]: c for c in inspect(conn).get_columns("fact_admetrics_daily")}
+    if "clicks" not in columns:
+        return
+    if conn.dialect.name == "sqlite":
+        # SQLite cannot change a column type in place; new databases get an
+        # INTEGER column from create_all and old ones have their values cast
+        conn.execute(
+            text(
+                "UPDATE fact_admetrics_daily "
+                "SET clicks = COALESCE(CAST(NULLIF(clicks, '') AS INTEGER), 0)"
+            )
+        )
+        return
+    if "CHAR" not in str(columns["clicks"]["type"]).upper():
+        return
+    conn.execute(
+        text("ALTER TABLE fact_admetrics_daily ALTER COLUMN clicks DROP DEFAULT")
+    )
+    conn.execute(
+        text(
+            "ALTER TABLE fact_admetrics_daily ALTER COLUMN clicks TYPE INTEGER "
+            "USING COALESCE(NULLIF(TRIM(clicks), '')::integer, 0)"
+        )
+    )
+    conn.execute(
+        text("ALTER TABLE fact_admetrics_daily ALTER COLUMN clicks SET DEFAULT 0")
+    )
+    conn.execute(
+        text("ALTER TABLE fact_admetrics_daily ALTER COLUMN clicks SET NOT NULL")
+    )
+
+
+def fact_updated_at(conn: Connection):
+    columns = {c["name"] for c in inspect(conn).get_columns("fact_admetrics_daily")}
+    if "updated_at" not in columns:
+        conn.execute(
+            text("ALTER TABLE fact_admetrics_daily ADD COLUMN updated_at TIMESTAMP")
+        )
+        conn.execute(
+            text("UPDATE fact_admetrics_daily SET updated_at = CURRENT_TIMESTAMP")
+        )
+        if conn.dialect.name != "sqlite":
+            # SQLite cannot add a column with a non-constant default; the model
+            # sets the value on every insert there
+            conn.execute(
+                text(
+                    "ALTER TABLE fact_admetrics_daily "
+                    "ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP"
+                )
+            )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_fact_admetrics_daily_updated_at "
+            "ON fact_admetrics_daily (updated_at)"
+        )
+    )
+    conn.execute(
+        text(
+            "INSERT INTO rollup_state (name, rows_processed, groups_refreshed, "
+            "duration_ms) SELECT 'daily', 0, 0, 0 WHERE NOT EXISTS "
+            "(SELECT 1 FROM rollup_state WHERE name = 'daily')"
+        )
+    )
+
+
+def fact_date_key(conn: Connection):
+    columns = {c["name"] for c in inspect(conn).get_columns("fact_admetrics_daily")}
+    for column in ("date_key", "hour"):
+        if column not in columns:
+            conn.execute(
+                text(f"ALTER TABLE fact_admetrics_daily ADD COLUMN {column} INTEGER")
+            )
+    conn.execute(
+        text(
+            "UPDATE fact_admetrics_daily SET "
+            "date_key = (SELECT CAST(REPLACE(d.date_created, '-', '') AS INTEGER) "
+            "FROM dimdates d WHERE d.id = fact_admetrics_daily.dim_date_id), "
+            "hour = (SELECT CAST(SUBSTR(d.time_created, 1, 2) AS INTEGER) "
+            "FROM dimdates d WHERE d.id = fact_admetrics_daily.dim_date_id) "
+            "WHERE date_key IS NULL AND dim_date_id IS NOT NULL"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_fact_admetrics_daily_date_key "
+            "ON fact_admetrics_daily (date_key)"
+        )
+    )
+
+
+def fact_filter_indexes(conn: Connection):
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_fact_admetrics_daily_ad_date "
+            "ON fact_admetrics_daily (advertise_id, date_key)"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_fact_admetrics_daily_user_ad_date "
+            "ON fact_admetrics_daily (register_user, advertise_id, date_key)"
+        )
+    )
+
+
+# Indexes create_all used to add that no query needs: the duplicate unique
+# index next to every primary key, single columns already covered by a unique
+# natural key or a composite index, booleans and other low-cardinality columns,
+# and columns that are never filtered on.
+REDUNDANT_INDEXES = {
+    "dimdates": ["id", "date_created", "time_created"],
+    "dimregion": ["id", "regionname", "cityname", "countryname"],
+    "dimagegroup": ["id", "age_range"],
+    "dimgender": ["id", "gender"],
+    "dimplatform": ["id", "platform_name", "platform_hostname"],
+    "dimdevicetype": ["id", "device_name"],
+    "user": ["id", "Name", "password", "dateofbirth", "gender_id", "agegroup_id"],
+    "guest_user": ["id", "ip_address", "guest_name", "location"],
+    "advertisement": [
+        "id",
+        "ad_promot_company_name",
+        "ad_run_hours",
+        "ad_cost",
+        "advertise_end_date",
+        "advertise_end_time",
+    ],
+    "fact_admetrics_daily": [
+        "id",
+        "advertise_id",
+        "impressions",
+        "clicks",
+        "likes",
+        "conversions",
+        "register_user",
+        "guest_user",
+        "dim_date_id",
+        "gender_id",
+    ],
+}
+
+
+def write_optimized_indexes(conn: Connection):
+    for table, columns in REDUNDANT_INDEXES.items():
+        for column in columns:
+            conn.execute(
+                text(f"DROP INDEX IF EXISTS {_quote(conn, f'ix_{table}_{column}')}")
+            )
+
+
+def advertisement_ends_at(conn: Connection):
+    columns = {c["name"] for c in inspect(conn).get_columns("advertisement")}
+    if "ends_at" not in columns:
+        conn.execute(text("ALTER TABLE advertisement ADD COLUMN ends_at TIMESTAMP"))
+    if "delivered_spend" not in columns:
+        conn.execute(
+            text(
+                "ALTER TABLE advertisement ADD COLUMN delivered_spend INTEGER DEFAULT 0"
+            )
+        )
+    if conn.dialect.name == "sqlite":
+        # datetime() is NULL for anything it cannot parse
+        ends_at = "datetime(advertise_end_date || ' ' || advertise_end_time)"
+        valid = "1 = 1"
+    else:
+        ends_at = (
+            "to_timestamp(advertise_end_date || ' ' || advertise_end_time, "
+            "'YYYY-MM-DD HH24:MI')::timestamp"
+        )
+        valid = (
+            "advertise_end_date ~ '^\\d{4}-\\d{2}-\\d{2}$' "
+            "AND advertise_end_time ~ '^\\d{2}:\\d{2}$'"
+        )
+    conn.execute(
+        text(
+            f"UPDATE advertisement SET ends_at = {ends_at} "
+            f"WHERE ends_at IS NULL AND {valid}"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_advertisement_ends_at "
+            "ON advertisement (ends_at)"
+        )
+    )
+
+
+MIGRATIONS = [
+    ("0001_dimension_natural_keys", deduplicate_dimensions),
+    ("0002_integer_clicks", integer_clicks),
+    ("0003_fact_updated_at", fact_updated_at),
+    ("0004_fact_date_key", fact_date_key),
+    ("0005_fact_filter_indexes", fact_filter_indexes),
+    ("0006_write_optimized_indexes", write_optimized_indexes),
+    ("0007_advertisement_ends_at", advertisement_ends_at),
+    ("0008_reach_sketches", backfill_reach_sketches),
+    # 0001 again, for databases that ran it before it coalesced NULLs
+    ("0009_dimension_empty_natural_keys", deduplicate_dimensions),
+]
+
+
+def lock_migrations(conn: Connection):
+    # Workers starting together would otherwise all create schema_migrations
+    # and run the same pending migrations
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+        )
+
+
+def applied_migrations(conn: Connection) -> set:
+    return {row[0] for row in conn.execute(text("SELECT id FROM schema_migrations"))}
+
+
+# Each migration runs in its own transaction under the lock, and re-reads
+# what is applied once it holds it, so a worker that waited on another skips
+# whatever that worker already ran.
+def run_migrations(engine: Engine):
+    with engine.begin() as conn:
+        lock_migrations(conn)
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations "
+                "(id VARCHAR PRIMARY KEY, applied_at VARCHAR)"
+            )
+        )
+        applied = applied_migrations(conn)
+
+    for migration_id, migration in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        with engine.begin() as conn:
+            lock_migrations(conn)
+            applied = applied_migrations(conn)
+            if migration_id in applied:
+                continue
+            migration(conn)
+            conn.execute(
+                text(
+                    "INSERT INTO schema_migrations (id, applied_at) "
+                    "VALUES (:id, :applied_at)"
+                ),
+                {"id": migration_id, "applied_at": datetime.now().isoformat()},
+            )
+        logger.info(f"Applied migration {migration_id}")
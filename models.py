@@ -1,108 +1,124 @@
-from sqlalchemy import Column, String, Text, ForeignKey, Boolean
+from sqlalchemy import (
+    Column,
+    String,
+    Text,
+    ForeignKey,
+    Boolean,
+    Index,
+    Integer,
+    DateTime,
+    Float,
+    LargeBinary,
+    func,
+)
 from database_connection import Base
 from datetime import datetime
-import uuid
+from identifiers import GUID, new_id
 
 
 class DimDates(Base):
     __tablename__ = "dimdates"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
+    id = Column(GUID, primary_key=True, default=new_id)
+    date_created = Column(String)
+    time_created = Column(String)
+
+    __table_args__ = (
+        Index("uq_dimdates_natural_key", "date_created", "time_created", unique=True),
     )
-    date_created = Column(String, index=True)
-    time_created = Column(String, index=True)
+
+
+# One row per day, keyed by an integer YYYYMMDD and filled ahead of time
+class DimCalendar(Base):
+    __tablename__ = "dimcalendar"
+
+    date_key = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(String, unique=True, nullable=False)
+    year = Column(Integer, nullable=False)
+    quarter = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    day_of_week = Column(Integer, nullable=False)
+    iso_week = Column(Integer, nullable=False)
+    is_weekend = Column(Boolean, nullable=False)
 
 
 class DimRegion(Base):
     __tablename__ = "dimregion"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
+    id = Column(GUID, primary_key=True, default=new_id)
+    regionname = Column(String)
+    cityname = Column(String)
+    countryname = Column(String)
+
+    __table_args__ = (
+        Index(
+            "uq_dimregion_natural_key",
+            "regionname",
+            "cityname",
+            "countryname",
+            unique=True,
+        ),
     )
-    regionname = Column(String, index=True)
-    cityname = Column(String, index=True)
-    countryname = Column(String, index=True)
 
 
 class DimAgeGroup(Base):
     __tablename__ = "dimagegroup"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
-    )
-    age_range = Column(String, index=True)
+    id = Column(GUID, primary_key=True, default=new_id)
+    age_range = Column(String)
+
+    __table_args__ = (Index("uq_dimagegroup_natural_key", "age_range", unique=True),)
 
 
 class DimGender(Base):
     __tablename__ = "dimgender"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
-    )
-    gender = Column(String, index=True)
+    id = Column(GUID, primary_key=True, default=new_id)
+    gender = Column(String)
+
+    __table_args__ = (Index("uq_dimgender_natural_key", "gender", unique=True),)
 
 
 class DimPlatform(Base):
     __tablename__ = "dimplatform"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
+    id = Column(GUID, primary_key=True, default=new_id)
+    platform_name = Column(String)
+    platform_hostname = Column(String)
+
+    __table_args__ = (
+        Index(
+            "uq_dimplatform_natural_key",
+            "platform_name",
+            "platform_hostname",
+            unique=True,
+        ),
     )
-    platform_name = Column(String, index=True)
-    platform_hostname = Column(String, index=True)
 
 
 class DimDeviceType(Base):
     __tablename__ = "dimdevicetype"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
+    id = Column(GUID, primary_key=True, default=new_id)
+    device_name = Column(String)
+
+    __table_args__ = (
+        Index("uq_dimdevicetype_natural_key", "device_name", unique=True),
     )
-    device_name = Column(String, index=True)
 
 
 class User(Base):
     __tablename__ = "user"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
-    )
-    Name = Column(String, index=True)
+    id = Column(GUID, primary_key=True, default=new_id)
+    Name = Column(String)
     email = Column(String, index=True)
-    password = Column(String, index=True)
-    dateofbirth = Column(String, index=True)
+    password = Column(String)
+    dateofbirth = Column(String)
     is_superadmin = Column(Boolean, default=False)
-    gender_id = Column(String, ForeignKey("dimgender.id"), index=True)
-    agegroup_id = Column(String, ForeignKey("dimagegroup.id"), index=True)
+    gender_id = Column(GUID, ForeignKey("dimgender.id"))
+    agegroup_id = Column(GUID, ForeignKey("dimagegroup.id"))
     created_date = Column(String, default=lambda: datetime.now().strftime("%d-%m-%Y"))
     created_time = Column(String, default=lambda: datetime.now().strftime("%H:%M:%S"))
 
@@ -110,65 +126,132 @@ class User(Base):
 class Guestuser(Base):
     __tablename__ = "guest_user"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
-    )
-    ip_address = Column(String, index=True)
-    guest_name = Column(String, index=True)
-    location = Column(String, index=True)
+    id = Column(GUID, primary_key=True, default=new_id)
+    ip_address = Column(String)
+    guest_name = Column(String)
+    location = Column(String)
 
 
 class Advertisement(Base):
     __tablename__ = "advertisement"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
-    )
-    ad_promot_company_name = Column(String, index=True)
+    id = Column(GUID, primary_key=True, default=new_id)
+    ad_promot_company_name = Column(String)
     ad_message = Column(Text, nullable=True)
     buy_url = Column(Text, nullable=True, default="http://localhost:8000")
-    ad_run_hours = Column(String, index=True)
-    ad_cost = Column(String, index=True, default="0")
+    ad_run_hours = Column(String)
+    ad_cost = Column(String, default="0")
     is_ad_active = Column(Boolean, default=True)
-    advertise_end_date = Column(String, index=True)
-    advertise_end_time = Column(String, index=True)
-    user = Column(String, ForeignKey("user.id"), index=True, nullable=True)
+    advertise_end_date = Column(String)
+    advertise_end_time = Column(String)
+    user = Column(GUID, ForeignKey("user.id"), index=True, nullable=True)
+    # advertise_end_date/time parsed once, for expiry and the ad index
+    ends_at = Column(DateTime, index=True, nullable=True)
+    # Recomputed from the fact table by the ad expiry job while the ad is live
+    delivered_spend = Column(Integer, default=0)
 
 
 class FactAdMetricsDaily(Base):
 
     __tablename__ = "fact_admetrics_daily"
 
-    id = Column(
-        String,
-        primary_key=True,
-        default=lambda: str(uuid.uuid4()),
-        unique=True,
-        index=True,
-    )
-    advertise_id = Column(
-        String, ForeignKey("advertisement.id"), index=True, nullable=True
+    id = Column(GUID, primary_key=True, default=new_id)
+    advertise_id = Column(GUID, ForeignKey("advertisement.id"), nullable=True)
+    impressions = Column(Boolean, default=False)
+    clicks = Column(Integer, default=0, nullable=False)
+    likes = Column(Boolean, default=False)
+    conversions = Column(Boolean, default=False)
+    register_user = Column(GUID, ForeignKey("user.id"), nullable=True)
+    guest_user = Column(GUID, ForeignKey("guest_user.id"), nullable=True)
+    dim_date_id = Column(GUID, ForeignKey("dimdates.id"), nullable=True)
+    platform_id = Column(GUID, ForeignKey("dimplatform.id"), index=True, nullable=True)
+    device_type_id = Column(
+        GUID, ForeignKey("dimdevicetype.id"), index=True, nullable=True
     )
-    impressions = Column(Boolean, index=True, default=False)
-    clicks = Column(String, index=True, default="0")
-    likes = Column(Boolean, index=True, default=False)
-    conversions = Column(Boolean, index=True, default=False)
-    register_user = Column(String, ForeignKey("user.id"), index=True, nullable=True)
-    guest_user = Column(String, ForeignKey("guest_user.id"), index=True, nullable=True)
-    dim_date_id = Column(String, ForeignKey("dimdates.id"), index=True, nullable=True)
-    platform_id = Column(
-        String, ForeignKey("dimplatform.id"), index=True, nullable=True
+    region_id = Column(GUID, ForeignKey("dimregion.id"), index=True, nullable=True)
+    gender_id = Column(GUID, ForeignKey("dimgender.id"))
+    # Event day (YYYYMMDD) and hour, so date filters need no join to dimdates
+    date_key = Column(Integer, ForeignKey("dimcalendar.date_key"), index=True)
+    hour = Column(Integer)
+    # Database clock, bumped on every write; the rollup job reads changes from it
+    updated_at = Column(
+        DateTime,
+        index=True,
+        default=func.now(),
+        server_default=func.now(),
+        onupdate=func.now(),
     )
-    device_type_id = Column(
-        String, ForeignKey("dimdevicetype.id"), index=True, nullable=True
+
+    # Equality filters first, then the date range
+    __table_args__ = (
+        Index("ix_fact_admetrics_daily_ad_date", "advertise_id", "date_key"),
+        Index(
+            "ix_fact_admetrics_daily_user_ad_date",
+            "register_user",
+            "advertise_id",
+            "date_key",
+        ),
     )
-    region_id = Column(String, ForeignKey("dimregion.id"), index=True, nullable=True)
-    gender_id = Column(String, ForeignKey("dimgender.id"), index=True)
+
+
+# Pre-summed facts per (day, advertisement, region, platform, device, gender).
+# Missing dimensions are stored as "" so every key column can be in the primary key.
+class FactAdMetricsRollup(Base):
+    __tablename__ = "fact_admetrics_rollup"
+
+    day = Column(String, primary_key=True)
+    advertise_id = Column(String, primary_key=True, default="")
+    region_id = Column(String, primary_key=True, default="")
+    platform_id = Column(String, primary_key=True, default="")
+    device_type_id = Column(String, primary_key=True, default="")
+    gender_id = Column(String, primary_key=True, default="")
+    fact_rows = Column(Integer, default=0, nullable=False)
+    impressions = Column(Integer, default=0, nullable=False)
+    likes = Column(Integer, default=0, nullable=False)
+    conversions = Column(Integer, default=0, nullable=False)
+    clicks = Column(Integer, default=0, nullable=False)
+
+
+class RollupState(Base):
+    __tablename__ = "rollup_state"
+
+    name = Column(String, primary_key=True)
+    high_water_mark = Column(DateTime, nullable=True)
+    last_run_at = Column(DateTime, nullable=True)
+    rows_processed = Column(Integer, default=0)
+    groups_refreshed = Column(Integer, default=0)
+    duration_ms = Column(Integer, default=0)
+
+
+# Bumped in the same transaction as a change to data that workers cache in
+# memory, so a worker can tell its copy is stale with one primary key lookup.
+class CacheVersion(Base):
+    __tablename__ = "cache_version"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
+
+# Last checkpoint of each ad's pacing buckets, restored when a worker starts:
+# spent is summed over all workers, tokens are those of the last to write
+class AdPacingState(Base):
+    __tablename__ = "ad_pacing_state"
+
+    advertise_id = Column(GUID, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    spent = Column(Integer, default=0, nullable=False)
+    # Epoch seconds the tokens were last refilled at
+    refilled_at = Column(Float, nullable=False)
+
+
+# HyperLogLog sketch of the distinct visitors of an ad on one day, for the
+# whole ad (dimension "") or one value of a dimension. See reach.py.
+class ReachSketch(Base):
+    __tablename__ = "reach_sketch"
+
+    advertise_id = Column(GUID, primary_key=True)
+    date_key = Column(Integer, primary_key=True)
+    dimension = Column(String, primary_key=True, default="")
+    dimension_value = Column(String, primary_key=True, default="")
+    # zlib compressed register array
+    registers = Column(LargeBinary, nullable=False)
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from typing import Optional
+from sqlalchemy import bindparam, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from fastapi import HTTPException, status
+from config import (
+    AD_PACING,
+    AD_IMPRESSION_PRICE,
+    AD_CLICK_PRICE,
+    PACING_WORKERS,
+    PACING_BURST_SECONDS,
+)
+from database_connection import SessionLocal
+from models import AdPacingState
+from ad_index import active_ads
+
+logger = logging.getLogger(__name__)
+
+state_table = AdPacingState.__table__
+
+checkpoint_update_statement = (
+    state_table.update()
+    .where(state_table.c.advertise_id == bindparam("ad_id"))
+    .values(
+        tokens=bindparam("tokens"),
+        spent=state_table.c.spent + bindparam("spent"),
+        refilled_at=bindparam("refilled_at"),
+    )
+)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "budget", "tokens", "spent", "refilled_at")
+
+    def __init__(self, rate: float, capacity: float, budget: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.budget = budget
+        self.tokens = min(capacity, budget)
+        self.spent = 0
+        self.refilled_at = now
+
+    def take(self, cost: int, now: float) -> bool:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.refilled_at) * self.rate
+        )
+        self.refilled_at = now
+        if self.tokens < cost or self.spent + cost > self.budget:
+            return False
+        self.tokens -= cost
+        self.spent += cost
+        return True
+
+
+def ad_bucket(ad: dict, now: float) -> Optional[TokenBucket]:
+    try:
+        budget = int(ad["ad_cost"])
+        seconds = int(ad["ad_run_hours"]) * 3600
+    except (TypeError, ValueError):
+        return None
+    if budget <= 0 or seconds <= 0:
+        return None
+    # Each worker paces its share: the budget, and with it the rate, the burst
+    # and the tokens a new bucket starts with, are split across the workers
+    budget = budget / PACING_WORKERS
+    rate = budget / seconds
+    # Room for at least one of the dearest event, or nothing could ever pass
+    capacity = max(rate * PACING_BURST_SECONDS, AD_IMPRESSION_PRICE, AD_CLICK_PRICE)
+    return TokenBucket(rate, capacity, budget, now)
+
+
+# One token bucket per live ad in this worker, built from the in-memory ad
+# index, so the pacing decision is a dict lookup and some arithmetic with no
+# database round trip. Ads missing from the index, or without a usable budget
+# and duration, are not paced.
+class PacingEngine:
+    def __init__(self):
+        self.buckets = {}
+        self.restored = {}  # ad id -> checkpointed state, used on first use
+        self.unsaved = {}  # ad id -> spend since the last checkpoint
+        self._lock = threading.Lock()
+
+    def allow(self, ad_id: str, cost: int) -> bool:
+        if not AD_PACING:
+            return True
+        now = time.time()
+        with self._lock:
+            bucket = self.buckets.get(ad_id)
+            if bucket is None:
+                entry = active_ads.ads.get(ad_id)
+                bucket = entry and ad_bucket(entry[0], now)
+                if bucket is None:
+                    return True
+                state = self.restored.pop(ad_id, None)
+                if state is not None:
+                    # The checkpoint holds the spend of all workers
+                    bucket.tokens = min(state["tokens"], bucket.capacity)
+                    bucket.spent = state["spent"] / PACING_WORKERS
+                    bucket.refilled_at = state["refilled_at"]
+                self.buckets[ad_id] = bucket
+            allowed = bucket.take(cost, now)
+            self.unsaved[ad_id] = self.unsaved.get(ad_id, 0) + (cost if allowed else 0)
+            return allowed
+
+    def restore(self, engine: Engine):
+        with engine.connect() as conn:
+            rows = conn.execute(select(state_table)).mappings()
+            with self._lock:
+                self.restored = {row["advertise_id"]: dict(row) for row in rows}
+
+    # Writes the buckets used since the last checkpoint: one batched UPDATE
+    # for ads already checkpointed and one batched INSERT for the rest. Every
+    # worker checkpoints the same row of an ad, so spend is added to it rather
+    # than overwritten; tokens are those of the last worker to write. Buckets
+    # of ads that left the index are dropped from memory.
+    def checkpoint(self, db: Session) -> int:
+        with self._lock:
+            states = {
+                ad_id: {
+                    "tokens": self.buckets[ad_id].tokens,
+                    "spent": spent,
+                    "refilled_at": self.buckets[ad_id].refilled_at,
+                }
+                for ad_id, spent in self.unsaved.items()
+                if ad_id in self.buckets
+            }
+            self.unsaved = {}
+            for ad_id in [a for a in self.buckets if a not in active_ads.ads]:
+                del self.buckets[ad_id]
+        if not states:
+            return 0
+
+        try:
+            existing = set(
+                db.execute(
+                    select(state_table.c.advertise_id).where(
+                        state_table.c.advertise_id.in_(list(states))
+                    )
+                ).scalars()
+            )
+            if existing:
+                db.execute(
+                    checkpoint_update_statement,
+                    [{"ad_id": ad_id, **states[ad_id]} for ad_id in existing],
+                )
+            new = [
+                {"advertise_id": ad_id, **state}
+                for ad_id, state in states.items()
+                if ad_id not in existing
+            ]
+            if new:
+                db.execute(insert(state_table), new)
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                for ad_id, state in states.items():
+                    self.unsaved[ad_id] = self.unsaved.get(ad_id, 0) + state["spent"]
+            raise
+        return len(states)
+
+
+pacer = PacingEngine()
+
+
+# Memory only: ads created on other workers reach the index through the
+# scheduler's ad index refresh, not through the request
+def enforce_pacing(ad_id: str, cost: int):
+    if not pacer.allow(ad_id, cost):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Advertisement is ahead of its budget pace, try again later",
+        )
+
+
+def run_pacing_checkpoint():
+    db = SessionLocal()
+    try:
+        buckets = pacer.checkpoint(db)
+        if buckets:
+            logger.info(f"Checkpointed {buckets} pacing buckets")
+    except Exception as e:
+        logger.error(f"Pacing checkpoint failed: {e}")
+    finally:
+        db.close()
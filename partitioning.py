@@ -0,0 +1,227 @@
+from datetime import date, datetime, timedelta
+import logging
+import re
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from config import (
+    FACT_PARTITIONING,
+    FACT_PARTITION_MONTHS_AHEAD,
+    FACT_RETENTION_DAYS,
+    FACT_RETENTION_ACTION,
+)
+from calendar_dimension import to_date_key
+from database_connection import engine
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLE = "fact_admetrics_daily"
+PARTITION_KEY = "date_key"
+DEFAULT_PARTITION = f"{PARTITIONED_TABLE}_default"
+partition_pattern = re.compile(rf"^{PARTITIONED_TABLE}_p(\d{{4}})(\d{{2}})$")
+
+# Result of the last maintenance run in this process, for /cron-status
+partition_status = {}
+
+
+def partitioning_enabled(engine: Engine) -> bool:
+    return FACT_PARTITIONING and engine.dialect.name == "postgresql"
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARTITIONED_TABLE}_p{month.year:04d}{month.month:02d}"
+
+
+def lock_partitions(conn: Connection):
+    # Serializes conversion and maintenance across workers
+    conn.execute(text(f"SELECT pg_advisory_xact_lock(hashtext('{PARTITIONED_TABLE}'))"))
+
+
+def is_partitioned(conn: Connection) -> bool:
+    return (
+        conn.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": PARTITIONED_TABLE},
+        ).scalar()
+        == "p"
+    )
+
+
+def attached_partitions(conn: Connection) -> list:
+    return list(
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:name)"
+            ),
+            {"name": PARTITIONED_TABLE},
+        ).scalars()
+    )
+
+
+# PostgreSQL refuses a new partition while the default partition holds rows
+# of its range, so those rows are staged in a temporary table, the partition
+# is created, and they are inserted back through the parent into it.
+def create_partition(conn: Connection, month: date) -> bool:
+    name = partition_name(month)
+    if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+        return False
+    start, end = to_date_key(month), to_date_key(add_months(month, 1))
+    in_range = f"{PARTITION_KEY} >= {start} AND {PARTITION_KEY} < {end}"
+    stranded = (
+        DEFAULT_PARTITION in attached_partitions(conn)
+        and conn.execute(
+            text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range})")
+        ).scalar()
+    )
+    if stranded:
+        staging = f"{name}_staging"
+        conn.execute(
+            text(
+                f"CREATE TEMPORARY TABLE {staging} (LIKE {DEFAULT_PARTITION}) "
+                "ON COMMIT DROP"
+            )
+        )
+        moved = conn.execute(
+            text(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE {in_range} "
+                f"RETURNING *) INSERT INTO {staging} SELECT * FROM moved"
+            )
+        ).rowcount
+    conn.execute(
+        text(
+            f"CREATE TABLE {name} PARTITION OF {PARTITIONED_TABLE} FOR VALUES "
+            f"FROM ({start}) TO ({end})"
+        )
+    )
+    if stranded:
+        conn.execute(text(f"INSERT INTO {PARTITIONED_TABLE} SELECT * FROM {staging}"))
+        conn.execute(text(f"DROP TABLE {staging}"))
+        logger.info(f"Moved {moved} rows from {DEFAULT_PARTITION} into {name}")
+    return True
+
+
+# Rebuilds the plain table as one partitioned by date_key, monthly. Runs once,
+# inside a single transaction, when partitioning is first switched on. Unique
+# indexes must contain the partition key, so uniqueness of id is enforced as
+# (id, date_key); rows without a date_key go to the default partition.
+def convert_to_partitioned(conn: Connection):
+    old_table = f"{PARTITIONED_TABLE}_unpartitioned"
+    inspector = inspect(conn)
+    indexes = inspector.get_indexes(PARTITIONED_TABLE)
+    foreign_keys = inspector.get_foreign_keys(PARTITIONED_TABLE)
+
+    conn.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} RENAME TO {old_table}"))
+    conn.execute(
+        text(
+            f"CREATE TABLE {PARTITIONED_TABLE} (LIKE {old_table} INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE ({PARTITION_KEY})"
+        )
+    )
+    conn.execute(
+        text(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARTITIONED_TABLE} DEFAULT"
+        )
+    )
+
+    month = date.today().replace(day=1)
+    months = {
+        add_months(month, offset) for offset in range(FACT_PARTITION_MONTHS_AHEAD + 1)
+    }
+    for (month_key,) in conn.execute(
+        text(
+            f"SELECT DISTINCT {PARTITION_KEY} / 100 FROM {old_table} "
+            f"WHERE {PARTITION_KEY} IS NOT NULL"
+        )
+    ):
+        months.add(date(month_key // 100, month_key % 100, 1))
+    for month in sorted(months):
+        create_partition(conn, month)
+
+    conn.execute(text(f"INSERT INTO {PARTITIONED_TABLE} SELECT * FROM {old_table}"))
+    conn.execute(text(f"DROP TABLE {old_table}"))
+
+    conn.execute(
+        text(
+            f"CREATE UNIQUE INDEX uq_{PARTITIONED_TABLE}_id "
+            f"ON {PARTITIONED_TABLE} (id, {PARTITION_KEY})"
+        )
+    )
+    for index in indexes:
+        unique = index["unique"] and PARTITION_KEY in index["column_names"]
+        conn.execute(
+            text(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX {index['name']} "
+                f"ON {PARTITIONED_TABLE} ({', '.join(index['column_names'])})"
+            )
+        )
+    for foreign_key in foreign_keys:
+        conn.execute(
+            text(
+                f"ALTER TABLE {PARTITIONED_TABLE} ADD FOREIGN KEY "
+                f"({', '.join(foreign_key['constrained_columns'])}) REFERENCES "
+                f"{conn.dialect.identifier_preparer.quote(foreign_key['referred_table'])} "
+                f"({', '.join(foreign_key['referred_columns'])})"
+            )
+        )
+    logger.info(f"Converted {PARTITIONED_TABLE} to monthly range partitions")
+
+
+# Creates partitions FACT_PARTITION_MONTHS_AHEAD months ahead and detaches or
+# drops the ones that end before the retention window.
+def maintain_partitions(conn: Connection) -> dict:
+    month = date.today().replace(day=1)
+    created = [
+        partition_name(add_months(month, offset))
+        for offset in range(FACT_PARTITION_MONTHS_AHEAD + 1)
+        if create_partition(conn, add_months(month, offset))
+    ]
+
+    expired = []
+    if FACT_RETENTION_DAYS > 0:
+        cutoff = to_date_key(date.today() - timedelta(days=FACT_RETENTION_DAYS))
+        for name in attached_partitions(conn):
+            match = partition_pattern.match(name)
+            if not match:
+                continue
+            start = date(int(match.group(1)), int(match.group(2)), 1)
+            if to_date_key(add_months(start, 1)) > cutoff:
+                continue
+            conn.execute(
+                text(f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}")
+            )
+            if FACT_RETENTION_ACTION == "drop":
+                conn.execute(text(f"DROP TABLE {name}"))
+            expired.append(name)
+
+    return {
+        "created": created,
+        "expired": expired,
+        "retention_action": FACT_RETENTION_ACTION,
+    }
+
+
+def ensure_partitioning(engine: Engine):
+    if not partitioning_enabled(engine):
+        return
+    with engine.begin() as conn:
+        lock_partitions(conn)
+        if not is_partitioned(conn):
+            convert_to_partitioned(conn)
+        partition_status.update(maintain_partitions(conn))
+        partition_status["last_run"] = datetime.now().isoformat()
+
+
+def run_partition_maintenance():
+    try:
+        ensure_partitioning(engine)
+        partition_status.pop("last_error", None)
+    except Exception as e:
+        partition_status["last_error"] = str(e)
+        partition_status["last_error_at"] = datetime.now().isoformat()
+        logger.error(f"Partition maintenance failed: {e}")
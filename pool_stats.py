@@ -0,0 +1,103 @@
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+
+class PoolStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.pool = None
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def on_checkout(self, *args):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def on_checkin(self, *args):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = {
+                "checkouts": self.checkouts,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "timeouts": self.timeouts,
+                "wait_ms_total": round(self.wait_seconds_total * 1000, 3),
+                "wait_ms_avg": (
+                    round(self.wait_seconds_total * 1000 / self.checkouts, 3)
+                    if self.checkouts
+                    else 0.0
+                ),
+                "wait_ms_max": round(self.wait_seconds_max * 1000, 3),
+            }
+        if self.pool is not None:
+            data["status"] = self.pool.status()
+            if isinstance(self.pool, QueuePool):
+                data["size"] = self.pool.size()
+                data["checked_in"] = self.pool.checkedin()
+                data["checked_out"] = self.pool.checkedout()
+                data["overflow"] = self.pool.overflow()
+        return data
+
+
+# Times how long callers wait for a connection, including queueing when the
+# pool is exhausted; checkout/checkin counts come from pool events.
+class TimedPoolMixin:
+    stats: PoolStats = None
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            if self.stats:
+                self.stats.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        if self.stats:
+            self.stats.record_wait(time.perf_counter() - started)
+        return connection
+
+
+class InstrumentedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+pool_stats = {}
+
+
+def instrument_pool(pool: Pool, name: str) -> PoolStats:
+    stats = PoolStats(name)
+    stats.pool = pool
+    if isinstance(pool, TimedPoolMixin):
+        pool.stats = stats
+    event.listen(pool, "checkout", stats.on_checkout)
+    event.listen(pool, "checkin", stats.on_checkin)
+    pool_stats[name] = stats
+    return stats
+
+
+def get_pool_stats() -> dict:
+    return {name: stats.snapshot() for name, stats in pool_stats.items()}
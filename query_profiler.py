@@ -0,0 +1,160 @@
+import collections
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import (
+    SLOW_QUERY_THRESHOLD_MS,
+    SLOW_QUERY_SAMPLE_RATE,
+    SLOW_QUERY_LOG_SIZE,
+    SLOW_QUERY_EXPLAIN,
+    SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS,
+)
+from cache import LRUCache
+from request_metrics import current_request
+
+logger = logging.getLogger(__name__)
+
+EXPLAINABLE = ("select", "with", "insert", "update", "delete")
+MAX_PARAMETER_LENGTH = 200
+
+
+class SlowQueryLog:
+    def __init__(self, size: int = SLOW_QUERY_LOG_SIZE):
+        self.records = collections.deque(maxlen=size)
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self._lock:
+            self.records.append(record)
+            self.recorded += 1
+
+    def snapshot(self, limit: int = None) -> dict:
+        with self._lock:
+            records = list(self.records)[::-1]
+            recorded = self.recorded
+        return {
+            "threshold_ms": SLOW_QUERY_THRESHOLD_MS,
+            "sample_rate": SLOW_QUERY_SAMPLE_RATE,
+            "capacity": self.records.maxlen,
+            "recorded_total": recorded,
+            "records": records[:limit] if limit else records,
+        }
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+
+slow_query_log = SlowQueryLog()
+
+# Statement texts explained within the last interval
+recently_explained = LRUCache(
+    maxsize=SLOW_QUERY_LOG_SIZE, ttl=SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS
+)
+_explain_lock = threading.Lock()
+
+
+def explain_due(statement: str) -> bool:
+    with _explain_lock:
+        if recently_explained.get(statement):
+            return False
+        recently_explained.set(statement, True)
+        return True
+
+
+def format_parameters(parameters):
+    if isinstance(parameters, dict):
+        return {key: format_parameters(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [format_parameters(value) for value in parameters]
+    if parameters is None or isinstance(parameters, (bool, int, float)):
+        return parameters
+    text = str(parameters)
+    if len(text) > MAX_PARAMETER_LENGTH:
+        text = text[:MAX_PARAMETER_LENGTH] + "..."
+    return text
+
+
+# Re-runs the statement under EXPLAIN on the same connection and transaction.
+# Only SELECTs are analyzed, since ANALYZE executes the statement and a second
+# run of a write would apply it twice; writes get the estimated plan. On
+# PostgreSQL a savepoint keeps a failing EXPLAIN from aborting the caller's
+# transaction.
+def explain(conn, statement: str, parameters) -> list:
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect == "postgresql":
+        analyze = statement.lstrip().lower().startswith("select")
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    else:
+        return None
+
+    conn.info["explaining"] = True
+    try:
+        if dialect == "postgresql":
+            conn.exec_driver_sql("SAVEPOINT slow_query_explain")
+        try:
+            rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+        except Exception as e:
+            if dialect == "postgresql":
+                conn.exec_driver_sql("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return [f"EXPLAIN failed: {e}"]
+        if dialect == "postgresql":
+            conn.exec_driver_sql("RELEASE SAVEPOINT slow_query_explain")
+            return [row[0] for row in rows]
+        return [row[-1] for row in rows]
+    finally:
+        conn.info.pop("explaining", None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # The sample decides up front, so unsampled statements cost one random()
+    if not conn.info.get("explaining") and random.random() < SLOW_QUERY_SAMPLE_RATE:
+        conn.info["slow_query_started"] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("slow_query_started", None)
+    if started is None:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    if duration_ms < SLOW_QUERY_THRESHOLD_MS:
+        return
+
+    stats = current_request.get()
+    plan = None
+    if (
+        SLOW_QUERY_EXPLAIN
+        and not executemany
+        and statement.lstrip().lower().startswith(EXPLAINABLE)
+        and explain_due(statement)
+    ):
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as e:
+            plan = [f"EXPLAIN failed: {e}"]
+    slow_query_log.add(
+        {
+            "timestamp": datetime.now().isoformat(),
+            "duration_ms": round(duration_ms, 3),
+            "route": stats.route if stats is not None else None,
+            "statement": statement,
+            "parameters": format_parameters(parameters),
+            "executemany": executemany,
+            "plan": plan,
+        }
+    )
+    logger.warning(f"Slow query ({duration_ms:.1f} ms): {statement[:200]}")
+
+
+def profile_queries(engine: Engine):
+    if SLOW_QUERY_SAMPLE_RATE <= 0:
+        return
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
@@ -0,0 +1,389 @@
+import hashlib
+import logging
+import math
+import threading
+import zlib
+from typing import List, Optional
+from fastapi import HTTPException, status
+from sqlalchemy import bindparam, distinct, insert, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import REACH_SKETCH_PRECISION
+from database_connection import SessionLocal
+from models import FactAdMetricsDaily, Guestuser, ReachSketch
+from calendar_dimension import to_date_key
+from reporting import filter_values
+
+logger = logging.getLogger(__name__)
+
+sketch_table = ReachSketch.__table__
+
+# Sketch dimension -> fact column it is split by. Every impression goes into
+# the whole-ad sketch ("") and into one sketch per dimension value, each per day.
+REACH_DIMENSIONS = {
+    "": None,
+    "region": "region_id",
+    "platform": "platform_id",
+    "device_type": "device_type_id",
+    "gender": "gender_id",
+}
+
+# 2 ** -rank for every possible register value
+INVERSE_POWERS = [2.0**-rank for rank in range(65)]
+
+update_sketch_statement = (
+    sketch_table.update()
+    .where(
+        sketch_table.c.advertise_id == bindparam("key_advertise_id"),
+        sketch_table.c.date_key == bindparam("key_date_key"),
+        sketch_table.c.dimension == bindparam("key_dimension"),
+        sketch_table.c.dimension_value == bindparam("key_dimension_value"),
+    )
+    .values(registers=bindparam("registers"))
+)
+
+
+def standard_error(precision: int = REACH_SKETCH_PRECISION) -> float:
+    return 1.04 / math.sqrt(1 << precision)
+
+
+# Guests get a new guest_user row per impression, so they are told apart by
+# their resolved client IP instead; repeat visits from one address count once.
+def visitor_hash(user_id=None, guest_ip=None) -> Optional[int]:
+    if user_id:
+        visitor = f"user:{user_id}"
+    elif guest_ip:
+        visitor = f"guest:{guest_ip}"
+    else:
+        return None
+    digest = hashlib.blake2b(visitor.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+# Register index from the top `precision` bits of the 64-bit hash, rank from
+# the position of the first 1 bit in the rest
+def hash_register(value: int, precision: int) -> tuple:
+    bits = 64 - precision
+    return value >> bits, bits - (value & ((1 << bits) - 1)).bit_length() + 1
+
+
+# Lowers a register to a smaller precision: the index bits that are dropped
+# become the leading bits of the rank
+def fold_register(index: int, rank: int, precision: int, target: int) -> tuple:
+    shift = precision - target
+    dropped = index & ((1 << shift) - 1)
+    if dropped:
+        rank = shift - dropped.bit_length() + 1
+    else:
+        rank += shift
+    return index >> shift, rank
+
+
+# HyperLogLog over 2 ** precision one-byte registers. Two sketches merge by
+# taking the larger of each register, so a merge of day or worker sketches is
+# exactly the sketch of the union, and merging the same data twice changes
+# nothing. The estimate has a relative standard error of 1.04 / sqrt(2 **
+# precision), 1.6% at the default precision of 12, whatever the cardinality.
+class HyperLogLog:
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = REACH_SKETCH_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = (
+            bytearray(registers) if registers is not None else bytearray(1 << precision)
+        )
+
+    @classmethod
+    def decode(cls, data: bytes) -> "HyperLogLog":
+        registers = zlib.decompress(data)
+        return cls(len(registers).bit_length() - 1, registers)
+
+    # Mostly empty register arrays, the common case for a single day, compress
+    # to a few dozen bytes
+    def encode(self) -> bytes:
+        return zlib.compress(bytes(self.registers))
+
+    def reduce(self, precision: int):
+        if precision >= self.precision:
+            return
+        registers = bytearray(1 << precision)
+        for index, rank in enumerate(self.registers):
+            if rank:
+                index, rank = fold_register(index, rank, self.precision, precision)
+                if rank > registers[index]:
+                    registers[index] = rank
+        self.precision, self.registers = precision, registers
+
+    # Merges sparse registers ({index: rank}) taken at the given precision
+    def update(self, registers: dict, precision: int):
+        self.reduce(precision)
+        for index, rank in registers.items():
+            if precision > self.precision:
+                index, rank = fold_register(index, rank, precision, self.precision)
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.reduce(other.precision)
+        if other.precision > self.precision:
+            other = HyperLogLog(other.precision, other.registers)
+            other.reduce(self.precision)
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(INVERSE_POWERS[rank] for rank in self.registers)
+        zeros = self.registers.count(0)
+        if zeros and raw <= 2.5 * m:
+            # Linear counting is more accurate while many registers are empty
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+
+def sketch_keys(fact: dict) -> list:
+    return [
+        (
+            fact["advertise_id"],
+            fact["date_key"],
+            dimension,
+            str(fact[column] or "") if column else "",
+        )
+        for dimension, column in REACH_DIMENSIONS.items()
+    ]
+
+
+# Merges sketches into the stored ones: one SELECT of the rows they touch,
+# then one batched UPDATE and one batched INSERT. On PostgreSQL the rows are
+# locked so two workers flushing the same key cannot lose each other's merge.
+def write_sketches(conn: Connection, pending: dict, precision: int) -> int:
+    query = select(sketch_table).where(
+        sketch_table.c.advertise_id.in_({key[0] for key in pending}),
+        sketch_table.c.date_key.in_({key[1] for key in pending}),
+    )
+    if conn.dialect.name == "postgresql":
+        query = query.with_for_update()
+    stored = {}
+    for row in conn.execute(query):
+        key = (row.advertise_id, row.date_key, row.dimension, row.dimension_value)
+        if key in pending:
+            stored[key] = row.registers
+
+    updates, inserts = [], []
+    for key, registers in pending.items():
+        if key in stored:
+            sketch = HyperLogLog.decode(stored[key])
+        else:
+            sketch = HyperLogLog(precision)
+        sketch.update(registers, precision)
+        values = dict(
+            zip(("advertise_id", "date_key", "dimension", "dimension_value"), key)
+        )
+        if key in stored:
+            updates.append(
+                {
+                    **{f"key_{name}": value for name, value in values.items()},
+                    "registers": sketch.encode(),
+                }
+            )
+        else:
+            inserts.append({**values, "registers": sketch.encode()})
+    if updates:
+        conn.execute(update_sketch_statement, updates)
+    if inserts:
+        conn.execute(insert(sketch_table), inserts)
+    return len(pending)
+
+
+# Sketch updates of this worker since the last flush, kept sparse as
+# {index: rank} per key: a busy interval touches many keys but few registers
+# of each, and a dense array per key would cost 2 ** precision bytes.
+class ReachSketches:
+    def __init__(self, precision: int = REACH_SKETCH_PRECISION):
+        self.precision = precision
+        self.pending = {}  # (ad, date_key, dimension, value) -> {index: rank}
+        self._lock = threading.Lock()
+
+    def add(self, fact: dict, guest_ip: Optional[str] = None):
+        value = visitor_hash(fact.get("register_user"), guest_ip)
+        if value is None or not fact.get("advertise_id"):
+            return
+        index, rank = hash_register(value, self.precision)
+        with self._lock:
+            for key in sketch_keys(fact):
+                registers = self.pending.setdefault(key, {})
+                if rank > registers.get(index, 0):
+                    registers[index] = rank
+
+    def drain(self) -> dict:
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def restore(self, pending: dict):
+        with self._lock:
+            for key, registers in pending.items():
+                current = self.pending.setdefault(key, {})
+                for index, rank in registers.items():
+                    if rank > current.get(index, 0):
+                        current[index] = rank
+
+    def unflushed(self, advertise_id: str, dimension: str) -> list:
+        with self._lock:
+            return [
+                (key, dict(registers))
+                for key, registers in self.pending.items()
+                if key[0] == advertise_id and key[2] == dimension
+            ]
+
+    def flush(self, db=None) -> int:
+        pending = self.drain()
+        if not pending:
+            return 0
+
+        own_session = db is None
+        db = db or SessionLocal()
+        try:
+            write_sketches(db.connection(), pending, self.precision)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.restore(pending)
+            logger.error(f"Reach flush failed, {len(pending)} sketches re-queued: {e}")
+            raise
+        finally:
+            if own_session:
+                db.close()
+        return len(pending)
+
+
+reach_sketches = ReachSketches()
+
+
+def flush_reach_sketches():
+    try:
+        sketches = reach_sketches.flush()
+        if sketches:
+            logger.info(f"Flushed {sketches} reach sketches")
+    except Exception:
+        # Already logged and re-queued for the next run
+        pass
+
+
+# Builds the sketches of facts written before they existed, one day at a time
+# so memory stays bounded by a day's keys. Merging is idempotent, so facts
+# that are already in a sketch do no harm.
+def backfill_reach_sketches(conn: Connection) -> int:
+    days = conn.execute(
+        select(distinct(FactAdMetricsDaily.date_key)).where(
+            FactAdMetricsDaily.date_key.is_not(None)
+        )
+    ).scalars()
+    columns = [
+        FactAdMetricsDaily.advertise_id,
+        FactAdMetricsDaily.date_key,
+        FactAdMetricsDaily.register_user,
+        Guestuser.ip_address,
+        *[getattr(FactAdMetricsDaily, c) for c in REACH_DIMENSIONS.values() if c],
+    ]
+    written = 0
+    for date_key in list(days):
+        sketches = ReachSketches()
+        rows = conn.execute(
+            select(*columns)
+            .outerjoin(Guestuser, Guestuser.id == FactAdMetricsDaily.guest_user)
+            .where(
+                FactAdMetricsDaily.date_key == date_key,
+                FactAdMetricsDaily.impressions.is_(True),
+            )
+            .execution_options(yield_per=5000)
+        )
+        for row in rows.mappings():
+            sketches.add(row, guest_ip=row["ip_address"])
+        pending = sketches.drain()
+        if pending:
+            written += write_sketches(conn, pending, sketches.precision)
+    return written
+
+
+# Sketches are per ad, so the endpoint takes exactly one, validated like the
+# id filters of the other metrics endpoints
+def parse_reach_advertise_id(advertise_id: str) -> str:
+    values = filter_values("advertise_id", [advertise_id])
+    if len(values) != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="advertise_id takes exactly one advertisement id",
+        )
+    return values[0]
+
+
+def parse_reach_dimension(dimension: Optional[str]) -> str:
+    dimension = (dimension or "").strip()
+    if dimension not in REACH_DIMENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown dimension {dimension!r}, expected any of "
+            f"{[name for name in REACH_DIMENSIONS if name]}",
+        )
+    return dimension
+
+
+# Merges the day sketches of one ad in the date range, one result per
+# dimension value. The cost grows with the number of days and dimension
+# values read, not with the number of impressions behind them. Impressions
+# this worker has not flushed yet are merged in too; those of other workers
+# show up after their next flush.
+async def reach_estimates(
+    db: AsyncSession,
+    advertise_id: str,
+    dimension: str = "",
+    values: List[str] = (),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+) -> List[dict]:
+    start_key = to_date_key(start_date) if start_date else None
+    end_key = to_date_key(end_date) if end_date else None
+
+    def selected(key) -> bool:
+        return (
+            (start_key is None or key[1] >= start_key)
+            and (end_key is None or key[1] <= end_key)
+            and (not values or key[3] in values)
+        )
+
+    query = select(sketch_table.c.dimension_value, sketch_table.c.registers).where(
+        sketch_table.c.advertise_id == advertise_id,
+        sketch_table.c.dimension == dimension,
+    )
+    if start_key:
+        query = query.where(sketch_table.c.date_key >= start_key)
+    if end_key:
+        query = query.where(sketch_table.c.date_key <= end_key)
+    if values:
+        query = query.where(sketch_table.c.dimension_value.in_(values))
+
+    merged = {}
+    for value, registers in (await db.execute(query)).all():
+        sketch = HyperLogLog.decode(registers)
+        if value in merged:
+            merged[value].merge(sketch)
+        else:
+            merged[value] = sketch
+    for key, registers in reach_sketches.unflushed(advertise_id, dimension):
+        if selected(key):
+            sketch = merged.setdefault(key[3], HyperLogLog(reach_sketches.precision))
+            sketch.update(registers, reach_sketches.precision)
+
+    if not dimension and not merged:
+        merged[""] = HyperLogLog()
+    return [
+        {
+            "advertise_id": advertise_id,
+            "dimension": dimension or None,
+            "dimension_value": value or None,
+            "reach": sketch.estimate(),
+            "standard_error": round(standard_error(sketch.precision), 4),
+        }
+        for value, sketch in sorted(merged.items())
+    ]
@@ -0,0 +1,342 @@
+from sqlalchemy import select, func, case, cast, String
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, List, Tuple
+import base64
+import binascii
+import json
+from datetime import datetime
+from fastapi import HTTPException, Query, status
+from database_connection import AsyncSessionLocal
+from models import (
+    FactAdMetricsDaily,
+    FactAdMetricsRollup,
+    DimCalendar,
+    DimRegion,
+    DimPlatform,
+    DimDeviceType,
+    DimGender,
+)
+from schemas import FactAdMetricsDailySchemas, FactMetricsFilters
+from config import METRICS_STREAM_BATCH_SIZE, METRICS_MAX_FILTER_VALUES
+from calendar_dimension import to_date_key
+from identifiers import is_valid_id
+from authentication import get_principal
+
+FACT_FIELDS = list(FactAdMetricsDailySchemas.model_fields)
+
+# Plain columns instead of ORM entities: rows go straight to JSON without an
+# identity map or a second round of schema validation
+fact_columns = [getattr(FactAdMetricsDaily, field) for field in FACT_FIELDS]
+
+# Stable, unique sort key for keyset pagination
+fact_sort_key = [FactAdMetricsDaily.id]
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(fact_sort_key)
+        or not is_valid_id(values[0])
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+    return values
+
+
+def validate_date_param(name: str, value: Optional[str]):
+    if value:
+        try:
+            datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{name} must be in YYYY-MM-DD format",
+            )
+
+
+# Query parameter -> fact column. Every filter takes one or more values,
+# repeated or comma separated, and all of them are ANDed into one WHERE clause.
+fact_filter_columns = {
+    "advertise_id": FactAdMetricsDaily.advertise_id,
+    "user_id": FactAdMetricsDaily.register_user,
+    "region_id": FactAdMetricsDaily.region_id,
+    "platform_id": FactAdMetricsDaily.platform_id,
+    "device_type_id": FactAdMetricsDaily.device_type_id,
+    "gender_id": FactAdMetricsDaily.gender_id,
+}
+
+
+def filter_values(name: str, values: Optional[List[str]]) -> List[str]:
+    values = [
+        value.strip()
+        for raw in values or []
+        for value in raw.split(",")
+        if value.strip()
+    ]
+    values = list(dict.fromkeys(values))
+    if len(values) > METRICS_MAX_FILTER_VALUES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{name} accepts at most {METRICS_MAX_FILTER_VALUES} values",
+        )
+    invalid = [value for value in values if not is_valid_id(value)]
+    if invalid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{name} has invalid ids {invalid[:10]}",
+        )
+    return values
+
+
+def fact_metrics_filters(
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    advertise_id: Optional[List[str]] = Query(None),
+    user_id: Optional[List[str]] = Query(None),
+    region_id: Optional[List[str]] = Query(None),
+    platform_id: Optional[List[str]] = Query(None),
+    device_type_id: Optional[List[str]] = Query(None),
+    gender_id: Optional[List[str]] = Query(None),
+) -> FactMetricsFilters:
+    validate_date_param("start_date", start_date)
+    validate_date_param("end_date", end_date)
+    return FactMetricsFilters(
+        start_date=start_date,
+        end_date=end_date,
+        **{
+            name: filter_values(name, values)
+            for name, values in (
+                ("advertise_id", advertise_id),
+                ("user_id", user_id),
+                ("region_id", region_id),
+                ("platform_id", platform_id),
+                ("device_type_id", device_type_id),
+                ("gender_id", gender_id),
+            )
+        },
+    )
+
+
+# Anyone logged in may filter on their own activity; other users' only a
+# superadmin
+async def authorize_user_filter(
+    db: AsyncSession, filters: FactMetricsFilters, caller_id: str
+):
+    if not filters.user_id or filters.user_id == [str(caller_id)]:
+        return
+    principal = await get_principal(db, caller_id)
+    if not principal or not principal["is_superadmin"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="user_id may only be your own id",
+        )
+
+
+def filter_conditions(filters: FactMetricsFilters, date_column, columns: dict) -> list:
+    # date_key columns are compared as YYYYMMDD integers, rollup days as strings
+    to_date = to_date_key if date_column is FactAdMetricsDaily.date_key else str
+    conditions = []
+    if filters.start_date:
+        conditions.append(date_column >= to_date(filters.start_date))
+    if filters.end_date:
+        conditions.append(date_column <= to_date(filters.end_date))
+    for name, column in columns.items():
+        values = getattr(filters, name)
+        if len(values) == 1:
+            conditions.append(column == values[0])
+        elif values:
+            conditions.append(column.in_(values))
+    return conditions
+
+
+def fact_metrics_query(filters: FactMetricsFilters):
+    return select(*fact_sort_key, *fact_columns).where(
+        *filter_conditions(filters, FactAdMetricsDaily.date_key, fact_filter_columns)
+    )
+
+
+def after_cursor(query, cursor: Optional[str] = None):
+    if cursor:
+        (last_id,) = decode_cursor(cursor)
+        query = query.where(FactAdMetricsDaily.id > last_id)
+    return query.order_by(*fact_sort_key)
+
+
+def row_to_dict(row) -> dict:
+    return dict(zip(FACT_FIELDS, row[len(fact_sort_key) :]))
+
+
+async def fact_metrics_page(
+    db, query, limit: int, cursor: Optional[str] = None
+) -> Tuple[List[dict], Optional[str]]:
+    # One extra row tells us whether there is a next page without a COUNT
+    rows = (await db.execute(after_cursor(query, cursor).limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1][: len(fact_sort_key)]))
+    return [row_to_dict(row) for row in rows], next_cursor
+
+
+# Runs on its own session: the request's session is closed by the dependency
+# before a streaming body is sent. stream() uses a server-side cursor and
+# fetches yield_per rows at a time, so memory stays flat for any result size.
+def stream_fact_metrics(query, cursor: Optional[str] = None):
+    # Ordered (and the cursor decoded) up front so a bad cursor is still a 400
+    statement = after_cursor(query, cursor).execution_options(
+        yield_per=METRICS_STREAM_BATCH_SIZE
+    )
+
+    async def rows():
+        async with AsyncSessionLocal() as session:
+            result = await session.stream(statement)
+            async for partition in result.partitions():
+                yield "".join(json.dumps(row_to_dict(row)) + "\n" for row in partition)
+
+    return rows()
+
+
+# group_by name -> (key column, dimension table joined on it, label columns)
+AGGREGATE_DIMENSIONS = {
+    "date": ("date", None, []),
+    "advertisement": ("advertise_id", None, []),
+    "region": (
+        "region_id",
+        DimRegion,
+        [DimRegion.regionname, DimRegion.cityname, DimRegion.countryname],
+    ),
+    "platform": ("platform_id", DimPlatform, [DimPlatform.platform_name]),
+    "device_type": ("device_type_id", DimDeviceType, [DimDeviceType.device_name]),
+    "gender": ("gender_id", DimGender, [DimGender.gender]),
+}
+
+AGGREGATE_SOURCES = ("rollup", "raw")
+
+
+def count_true(column):
+    return func.count(case((column.is_(True), 1)))
+
+
+fact_aggregate_keys = {
+    "date": FactAdMetricsDaily.date_key,
+    "advertise_id": FactAdMetricsDaily.advertise_id,
+    "region_id": FactAdMetricsDaily.region_id,
+    "platform_id": FactAdMetricsDaily.platform_id,
+    "device_type_id": FactAdMetricsDaily.device_type_id,
+    "gender_id": FactAdMetricsDaily.gender_id,
+}
+
+fact_aggregate_measures = [
+    func.count().label("rows"),
+    count_true(FactAdMetricsDaily.impressions).label("impressions"),
+    count_true(FactAdMetricsDaily.likes).label("likes"),
+    count_true(FactAdMetricsDaily.conversions).label("conversions"),
+    func.coalesce(func.sum(FactAdMetricsDaily.clicks), 0).label("clicks"),
+]
+
+rollup_aggregate_keys = {
+    "date": FactAdMetricsRollup.day,
+    "advertise_id": FactAdMetricsRollup.advertise_id,
+    "region_id": FactAdMetricsRollup.region_id,
+    "platform_id": FactAdMetricsRollup.platform_id,
+    "device_type_id": FactAdMetricsRollup.device_type_id,
+    "gender_id": FactAdMetricsRollup.gender_id,
+}
+
+rollup_aggregate_measures = [
+    func.coalesce(func.sum(column), 0).label(name)
+    for name, column in (
+        ("rows", FactAdMetricsRollup.fact_rows),
+        ("impressions", FactAdMetricsRollup.impressions),
+        ("likes", FactAdMetricsRollup.likes),
+        ("conversions", FactAdMetricsRollup.conversions),
+        ("clicks", FactAdMetricsRollup.clicks),
+    )
+]
+
+
+def parse_group_by(group_by: Optional[str]) -> List[str]:
+    names = [name.strip() for name in (group_by or "").split(",") if name.strip()]
+    unknown = [name for name in names if name not in AGGREGATE_DIMENSIONS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown group_by {unknown}, expected any of "
+            f"{list(AGGREGATE_DIMENSIONS)}",
+        )
+    return list(dict.fromkeys(names))
+
+
+# "rollup" reads the pre-summed daily table maintained by the rollup job and
+# lags it by one refresh; "raw" groups the fact table directly. The rollup has
+# no per-user rows, so user filters always read the fact table.
+def aggregate_query(
+    group_by: List[str], filters: FactMetricsFilters, source: str = "rollup"
+):
+    if source == "rollup" and not filters.user_id:
+        table, keys, measures = (
+            FactAdMetricsRollup,
+            rollup_aggregate_keys,
+            rollup_aggregate_measures,
+        )
+        filter_columns = {
+            name: keys[name] for name in fact_filter_columns if name in keys
+        }
+    else:
+        table, keys, measures = (
+            FactAdMetricsDaily,
+            fact_aggregate_keys,
+            fact_aggregate_measures,
+        )
+        filter_columns = fact_filter_columns
+
+    columns = []
+    for name in group_by:
+        key, _, labels = AGGREGATE_DIMENSIONS[name]
+        if table is FactAdMetricsDaily and key == "date":
+            # Grouped on the integer key, labelled from the calendar
+            columns += [FactAdMetricsDaily.date_key, DimCalendar.date]
+        else:
+            columns += [keys[key].label(key), *labels]
+    query = select(*columns, *measures).select_from(table)
+
+    if table is FactAdMetricsDaily and "date" in group_by:
+        query = query.outerjoin(
+            DimCalendar, FactAdMetricsDaily.date_key == DimCalendar.date_key
+        )
+    for name in group_by:
+        key, dimension, _ = AGGREGATE_DIMENSIONS[name]
+        if dimension is not None:
+            dimension_id = dimension.id
+            if table is FactAdMetricsRollup:
+                dimension_id = cast(dimension.id, String)
+            query = query.outerjoin(dimension, keys[key] == dimension_id)
+
+    query = query.where(*filter_conditions(filters, keys["date"], filter_columns))
+    if columns:
+        query = query.group_by(*columns).order_by(*columns)
+    return query
+
+
+def with_rates(row: dict) -> dict:
+    # The rollup stores missing dimensions as ""
+    row = {key: None if value == "" else value for key, value in row.items()}
+    row.pop("date_key", None)
+    impressions = row["impressions"]
+    row["ctr"] = row["clicks"] / impressions if impressions else 0.0
+    row["conversion_rate"] = row["conversions"] / impressions if impressions else 0.0
+    return row
+
+
+async def aggregate_fact_metrics(db, query) -> List[dict]:
+    result = await db.execute(query)
+    return [with_rates(dict(row)) for row in result.mappings()]
@@ -0,0 +1,256 @@
+import contextvars
+import functools
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import SERVER_TIMING_HEADER
+from pool_stats import pool_stats
+
+# Upper bounds in seconds, Prometheus' default buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats:
+    def __init__(self, route: str = None):
+        self.route = route
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.external_seconds = 0.0
+
+
+# Set by the middleware for the duration of a request. Sync handlers run in the
+# threadpool with a copy of the context, which still points at the same object.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.latency = {}  # (method, route) -> Histogram
+        self.responses = {}  # (method, route, status) -> count
+        self.sql_statements = {}  # (method, route) -> count
+        self.sql_seconds = {}  # (method, route) -> seconds
+        self.external_seconds = {}  # (method, route) -> seconds
+        self.lookups = {}  # lookup name -> Histogram
+        self._lock = threading.Lock()
+
+    def record_request(
+        self, method: str, route: str, status: int, seconds: float, stats: RequestStats
+    ):
+        key = (method, route)
+        with self._lock:
+            self.latency.setdefault(key, Histogram()).observe(seconds)
+            status_key = (method, route, status)
+            self.responses[status_key] = self.responses.get(status_key, 0) + 1
+            self.sql_statements[key] = (
+                self.sql_statements.get(key, 0) + stats.sql_statements
+            )
+            self.sql_seconds[key] = self.sql_seconds.get(key, 0.0) + stats.sql_seconds
+            self.external_seconds[key] = (
+                self.external_seconds.get(key, 0.0) + stats.external_seconds
+            )
+
+    def record_lookup(self, name: str, seconds: float):
+        with self._lock:
+            self.lookups.setdefault(name, Histogram()).observe(seconds)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            histogram_lines(
+                lines,
+                "http_request_duration_seconds",
+                "Request latency by route",
+                {
+                    labels(method=method, route=route): histogram
+                    for (method, route), histogram in self.latency.items()
+                },
+            )
+            counter_lines(
+                lines,
+                "http_responses_total",
+                "Responses by route and status",
+                {
+                    labels(method=method, route=route, status=status): count
+                    for (method, route, status), count in self.responses.items()
+                },
+            )
+            for name, help_text, values in (
+                (
+                    "http_request_db_statements_total",
+                    "SQL statements executed by requests",
+                    self.sql_statements,
+                ),
+                (
+                    "http_request_db_seconds_total",
+                    "Time requests spent executing SQL",
+                    self.sql_seconds,
+                ),
+                (
+                    "http_request_external_seconds_total",
+                    "Time requests spent in external lookups",
+                    self.external_seconds,
+                ),
+            ):
+                counter_lines(
+                    lines,
+                    name,
+                    help_text,
+                    {
+                        labels(method=method, route=route): value
+                        for (method, route), value in values.items()
+                    },
+                )
+            histogram_lines(
+                lines,
+                "external_lookup_duration_seconds",
+                "Latency of external lookups",
+                {
+                    labels(lookup=name): histogram
+                    for name, histogram in self.lookups.items()
+                },
+            )
+
+        pools = {name: stats.snapshot() for name, stats in pool_stats.items()}
+        for name, key, kind, help_text in (
+            ("db_pool_in_use", "in_use", "gauge", "Connections checked out"),
+            ("db_pool_checkouts_total", "checkouts", "counter", "Pool checkouts"),
+            ("db_pool_timeouts_total", "timeouts", "counter", "Pool checkout timeouts"),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [
+                f"{name}{labels(pool=pool)} {snapshot[key]}"
+                for pool, snapshot in pools.items()
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**values) -> str:
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in values.items()) + "}"
+
+
+def counter_lines(lines: list, name: str, help_text: str, values: dict):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    lines += [f"{name}{label} {value}" for label, value in values.items()]
+
+
+def histogram_lines(lines: list, name: str, help_text: str, histograms: dict):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for label, histogram in histograms.items():
+        for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+            lines.append(f'{name}_bucket{label[:-1]},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{label[:-1]},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{label} {histogram.sum}")
+        lines.append(f"{name}_count{label} {histogram.count}")
+
+
+metrics = MetricsRegistry()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started", None)
+    stats = current_request.get()
+    if stats is not None and started is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += time.perf_counter() - started
+
+
+def instrument_queries(engine: Engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+# Wraps a blocking call to an outside service (geo lookup, ipinfo, ...) so its
+# latency shows up per lookup and in the calling request's external time.
+def timed_lookup(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - started
+                metrics.record_lookup(name, seconds)
+                stats = current_request.get()
+                if stats is not None:
+                    stats.external_seconds += seconds
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing(stats: RequestStats, seconds: float) -> str:
+    return (
+        f'db;dur={stats.sql_seconds * 1000:.1f};desc="{stats.sql_statements} queries", '
+        f"ext;dur={stats.external_seconds * 1000:.1f}, "
+        f"app;dur={seconds * 1000:.1f}"
+    )
+
+
+# Plain ASGI middleware rather than BaseHTTPMiddleware so streaming responses
+# pass through untouched. Routes are labelled with their path template, and
+# requests that match no route share one label to keep cardinality bounded.
+# Server-Timing goes out with the response headers, so the queries of a
+# streamed body are counted in /metrics but not in the header.
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(f"{scope['method']} {scope['path']}")
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING_HEADER:
+                    header = server_timing(stats, time.perf_counter() - started)
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", header.encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            metrics.record_request(
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                status_code,
+                time.perf_counter() - started,
+                stats,
+            )
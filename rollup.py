@@ -0,0 +1,175 @@
+from sqlalchemy import select, insert, delete, func, cast, literal, or_, true, String
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from typing import List
+import logging
+import time
+from config import ROLLUP_OVERLAP_SECONDS
+from database_connection import SessionLocal
+from models import FactAdMetricsDaily, FactAdMetricsRollup, RollupState
+from reporting import count_true
+from calendar_dimension import from_date_key
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_NAME = "daily"
+
+# Advertisements recomputed per DELETE + INSERT ... SELECT
+ROLLUP_CHUNK_SIZE = 500
+
+rollup_keys = [
+    FactAdMetricsDaily.advertise_id,
+    FactAdMetricsDaily.region_id,
+    FactAdMetricsDaily.platform_id,
+    FactAdMetricsDaily.device_type_id,
+    FactAdMetricsDaily.gender_id,
+]
+
+
+def advertise_filter(advertise_ids: List[str]):
+    ids = [ad_id for ad_id in advertise_ids if ad_id]
+    condition = FactAdMetricsDaily.advertise_id.in_(ids)
+    if len(ids) < len(advertise_ids):
+        condition = or_(condition, FactAdMetricsDaily.advertise_id.is_(None))
+    return condition
+
+
+def rollup_select(date_key: int, advertise_ids: List[str]):
+    # Rollup keys are text whatever the fact key type is
+    keys = [func.coalesce(cast(column, String), "") for column in rollup_keys]
+    return (
+        select(
+            literal(from_date_key(date_key).strftime("%Y-%m-%d")),
+            *keys,
+            func.count(),
+            count_true(FactAdMetricsDaily.impressions),
+            count_true(FactAdMetricsDaily.likes),
+            count_true(FactAdMetricsDaily.conversions),
+            func.coalesce(func.sum(FactAdMetricsDaily.clicks), 0),
+        )
+        .where(
+            FactAdMetricsDaily.date_key == date_key,
+            advertise_filter(advertise_ids),
+        )
+        .group_by(*keys)
+    )
+
+
+rollup_columns = [
+    "day",
+    "advertise_id",
+    "region_id",
+    "platform_id",
+    "device_type_id",
+    "gender_id",
+    "fact_rows",
+    "impressions",
+    "likes",
+    "conversions",
+    "clicks",
+]
+
+
+# Facts are mutable (likes, clicks and conversions change after insert), so
+# instead of adding deltas the job finds every (day, advertisement) touched
+# since the high-water mark and recomputes those groups from the fact table.
+# Recomputing is idempotent, which is what makes the overlap window safe.
+def refresh_rollup(db: Session) -> dict:
+    started = time.perf_counter()
+    # Row lock so only one worker refreshes at a time
+    state = db.get(RollupState, ROLLUP_NAME, with_for_update=True)
+    if state is None:
+        state = RollupState(name=ROLLUP_NAME)
+        db.add(state)
+
+    changed = true()
+    if state.high_water_mark:
+        changed = FactAdMetricsDaily.updated_at > state.high_water_mark - timedelta(
+            seconds=ROLLUP_OVERLAP_SECONDS
+        )
+
+    rows_processed, high_water_mark = db.execute(
+        select(func.count(), func.max(FactAdMetricsDaily.updated_at)).where(changed)
+    ).one()
+
+    touched = {}
+    for date_key, advertise_id in db.execute(
+        select(FactAdMetricsDaily.date_key, FactAdMetricsDaily.advertise_id)
+        .where(changed, FactAdMetricsDaily.date_key.is_not(None))
+        .distinct()
+    ):
+        touched.setdefault(date_key, set()).add(advertise_id or "")
+
+    groups_refreshed = 0
+    for date_key, advertise_ids in touched.items():
+        day = from_date_key(date_key).strftime("%Y-%m-%d")
+        advertise_ids = sorted(advertise_ids)
+        for i in range(0, len(advertise_ids), ROLLUP_CHUNK_SIZE):
+            chunk = advertise_ids[i : i + ROLLUP_CHUNK_SIZE]
+            db.execute(
+                delete(FactAdMetricsRollup).where(
+                    FactAdMetricsRollup.day == day,
+                    FactAdMetricsRollup.advertise_id.in_(chunk),
+                )
+            )
+            groups_refreshed += db.execute(
+                insert(FactAdMetricsRollup).from_select(
+                    rollup_columns, rollup_select(date_key, chunk)
+                )
+            ).rowcount
+
+    if high_water_mark and (
+        state.high_water_mark is None or high_water_mark > state.high_water_mark
+    ):
+        state.high_water_mark = high_water_mark
+    state.last_run_at = datetime.now()
+    state.rows_processed = rows_processed
+    state.groups_refreshed = groups_refreshed
+    state.duration_ms = int((time.perf_counter() - started) * 1000)
+    db.commit()
+    return {
+        "rows_processed": rows_processed,
+        "groups_refreshed": groups_refreshed,
+        "duration_ms": state.duration_ms,
+    }
+
+
+def run_rollup_refresh():
+    db = SessionLocal()
+    try:
+        stats = refresh_rollup(db)
+        if stats["rows_processed"]:
+            logger.info(
+                f"Rollup refreshed {stats['groups_refreshed']} groups from "
+                f"{stats['rows_processed']} changed facts in {stats['duration_ms']} ms"
+            )
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Rollup refresh failed: {e}")
+    finally:
+        db.close()
+
+
+async def rollup_status(db: AsyncSession) -> dict:
+    state = await db.get(RollupState, ROLLUP_NAME)
+    if state is None or state.last_run_at is None:
+        return {"last_run": None}
+    pending_rows = await db.scalar(
+        select(func.count()).where(
+            FactAdMetricsDaily.updated_at > state.high_water_mark
+        )
+        if state.high_water_mark
+        else select(func.count()).select_from(FactAdMetricsDaily)
+    )
+    return {
+        "last_run": state.last_run_at.isoformat(),
+        "rows_processed": state.rows_processed,
+        "groups_refreshed": state.groups_refreshed,
+        "duration_ms": state.duration_ms,
+        "high_water_mark": (
+            state.high_water_mark.isoformat() if state.high_water_mark else None
+        ),
+        "lag_seconds": round((datetime.now() - state.last_run_at).total_seconds(), 3),
+        "pending_rows": pending_rows,
+    }
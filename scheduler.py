@@ -2,6 +2,25 @@ import asyncio
 from datetime import datetime
 import logging
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from click_aggregator import flush_click_aggregator
+from rollup import run_rollup_refresh
+from ad_accounting import run_ad_expiry
+from pacing import run_pacing_checkpoint
+from reach import flush_reach_sketches
+from ad_index import run_ad_index_refresh
+from partitioning import partitioning_enabled, run_partition_maintenance
+from database_connection import engine
+from config import (
+    CLICK_DURABILITY,
+    CLICK_FLUSH_INTERVAL_SECONDS,
+    ROLLUP_REFRESH_INTERVAL_SECONDS,
+    FACT_PARTITION_MAINTENANCE_HOURS,
+    AD_EXPIRY_INTERVAL_SECONDS,
+    AD_INDEX_CHECK_SECONDS,
+    AD_PACING,
+    PACING_CHECKPOINT_SECONDS,
+    REACH_FLUSH_INTERVAL_SECONDS,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -19,12 +38,59 @@ for handler in logger.handlers:
     handler.flush = lambda: handler.stream.flush()
 
 
-async def log_timestamp():
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"Logging timestamp: {timestamp}")
-    logging.info(f"Timestamp: {timestamp}")
-
-
 def setup_scheduler():
-    scheduler.add_job(log_timestamp, "interval", hours=6, replace_existing=True,id='log_timestamp_job')
+    scheduler.add_job(
+        run_rollup_refresh,
+        "interval",
+        seconds=ROLLUP_REFRESH_INTERVAL_SECONDS,
+        next_run_time=datetime.now(),
+        replace_existing=True,
+        id="rollup_refresh_job",
+    )
+    scheduler.add_job(
+        run_ad_expiry,
+        "interval",
+        seconds=AD_EXPIRY_INTERVAL_SECONDS,
+        next_run_time=datetime.now(),
+        replace_existing=True,
+        id="ad_expiry_job",
+    )
+    scheduler.add_job(
+        run_ad_index_refresh,
+        "interval",
+        seconds=AD_INDEX_CHECK_SECONDS,
+        replace_existing=True,
+        id="ad_index_refresh_job",
+    )
+    scheduler.add_job(
+        flush_reach_sketches,
+        "interval",
+        seconds=REACH_FLUSH_INTERVAL_SECONDS,
+        replace_existing=True,
+        id="reach_flush_job",
+    )
+    if AD_PACING:
+        scheduler.add_job(
+            run_pacing_checkpoint,
+            "interval",
+            seconds=PACING_CHECKPOINT_SECONDS,
+            replace_existing=True,
+            id="pacing_checkpoint_job",
+        )
+    if partitioning_enabled(engine):
+        scheduler.add_job(
+            run_partition_maintenance,
+            "interval",
+            hours=FACT_PARTITION_MAINTENANCE_HOURS,
+            replace_existing=True,
+            id="partition_maintenance_job",
+        )
+    if CLICK_DURABILITY != "sync":
+        scheduler.add_job(
+            flush_click_aggregator,
+            "interval",
+            seconds=CLICK_FLUSH_INTERVAL_SECONDS,
+            replace_existing=True,
+            id="click_flush_job",
+        )
     scheduler.start()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, validator
-from typing import Optional
+from typing import Optional, List
 from datetime import datetime
 
 
@@ -7,7 +7,7 @@ class FactAdMetricsDailySchemas(BaseModel):
     advertise_id: str
     likes: Optional[bool] = False
     impressions: Optional[bool] = False
-    clicks: Optional[str] = None
+    clicks: Optional[int] = None
     conversions: Optional[bool] = False
     register_user: Optional[str] = None
     guest_user: Optional[str] = None
@@ -21,6 +21,62 @@ class FactAdMetricsDailySchemas(BaseModel):
         from_attributes = True
 
 
+class BatchItemResult(BaseModel):
+    index: int
+    status: str
+    id: Optional[str] = None
+    detail: Optional[str] = None
+
+
+class BatchIngestResponse(BaseModel):
+    created: int
+    updated: int
+    failed: int
+    paced: int = 0
+    results: List[BatchItemResult]
+
+
+class FactMetricsFilters(BaseModel):
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    advertise_id: List[str] = []
+    user_id: List[str] = []
+    region_id: List[str] = []
+    platform_id: List[str] = []
+    device_type_id: List[str] = []
+    gender_id: List[str] = []
+
+
+class MetricsAggregate(BaseModel):
+    date: Optional[str] = None
+    advertise_id: Optional[str] = None
+    region_id: Optional[str] = None
+    regionname: Optional[str] = None
+    cityname: Optional[str] = None
+    countryname: Optional[str] = None
+    platform_id: Optional[str] = None
+    platform_name: Optional[str] = None
+    device_type_id: Optional[str] = None
+    device_name: Optional[str] = None
+    gender_id: Optional[str] = None
+    gender: Optional[str] = None
+    rows: int
+    impressions: int
+    likes: int
+    conversions: int
+    clicks: int
+    ctr: float
+    conversion_rate: float
+
+
+class ReachEstimate(BaseModel):
+    advertise_id: str
+    dimension: Optional[str] = None
+    dimension_value: Optional[str] = None
+    reach: int
+    standard_error: float
+
+
 class AdvertisementSchema(BaseModel):
     id: Optional[str] = None
     ad_promot_company_name: Optional[str] = None
@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+import threading
+import uuid
+import pytest
+from sqlalchemy import event
+
+# Configuration is read at import time, so the test database has to be set
+# before any application module is imported
+os.environ["DATABASE_URL"] = os.getenv(
+    "TEST_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db"
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_connection import Base, engine, SessionLocal  # noqa: E402
+import models  # noqa: E402,F401
+from calendar_dimension import ensure_calendar  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def tables():
+    Base.metadata.create_all(bind=engine)
+    ensure_calendar(engine)
+    yield
+    engine.dispose()
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def advertise_id(db):
+    ad = models.Advertisement(ad_promot_company_name="test", ad_run_hours="1")
+    db.add(ad)
+    db.commit()
+    return ad.id
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    # Entered once, so every request runs on the same event loop as the
+    # pooled async connections
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def auth_headers(client, superadmin: bool = False) -> dict:
+    email = f"{uuid.uuid4().hex}@example.com"
+    client.post(
+        "/users/",
+        json={
+            "Name": "test",
+            "email": email,
+            "dateofbirth": "1990-01-01",
+            "gender": "female",
+            "password": "pw",
+            "is_superadmin": superadmin,
+        },
+    )
+    token = client.post("/login-user/", json={"email": email, "password": "pw"}).json()[
+        "access_token"
+    ]
+    return {"Authorization": f"Bearer {token}"}
+
+
+# Counts this thread's statements only, not those of scheduler jobs
+class StatementCounter:
+    def __init__(self):
+        self.statements = []
+        self.thread = threading.get_ident()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread:
+            self.statements.append(statement)
+
+
+def count_statements(func, *args, **kwargs) -> list:
+    counter = StatementCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        func(*args, **kwargs)
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+    return counter.statements
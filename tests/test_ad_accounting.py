@@ -0,0 +1,67 @@
+from datetime import date, datetime
+from sqlalchemy import insert, update
+import models
+from calendar_dimension import to_date_key
+import ad_accounting
+from ad_accounting import (
+    SPEND_STATE_NAME,
+    ad_expiry_status,
+    expire_ads,
+    run_ad_expiry,
+)
+from config import AD_CLICK_PRICE, AD_IMPRESSION_PRICE
+from models import FactAdMetricsDaily, RollupState
+
+
+def add_fact(db, advertise_id, clicks=0):
+    db.execute(
+        insert(FactAdMetricsDaily).values(
+            advertise_id=advertise_id,
+            date_key=to_date_key(date.today()),
+            impressions=True,
+            clicks=clicks,
+        )
+    )
+    db.commit()
+
+
+def test_spend_is_settled_only_for_ads_with_new_facts(db, advertise_id):
+    other = models.Advertisement(ad_promot_company_name="other", ad_run_hours="1")
+    db.add(other)
+    db.commit()
+    add_fact(db, advertise_id, clicks=2)
+    add_fact(db, other.id)
+
+    expire_ads(db)
+    ad = db.get(models.Advertisement, advertise_id)
+    db.refresh(ad)
+    assert ad.delivered_spend == AD_IMPRESSION_PRICE + 2 * AD_CLICK_PRICE
+
+    # Age every fact and the mark well past the overlap window, then
+    # overwrite the other ad's figure: a full rescan would restore it
+    db.execute(update(FactAdMetricsDaily).values(updated_at=datetime(2000, 1, 1)))
+    db.get(RollupState, SPEND_STATE_NAME).high_water_mark = datetime(2000, 1, 2)
+    other.delivered_spend = 999
+    db.commit()
+    add_fact(db, advertise_id, clicks=1)
+
+    status = expire_ads(db)
+    db.refresh(ad)
+    db.refresh(other)
+    assert status["facts_processed"] == 1
+    assert ad.delivered_spend == 2 * AD_IMPRESSION_PRICE + 3 * AD_CLICK_PRICE
+    assert other.delivered_spend == 999
+
+
+def test_a_successful_run_clears_the_last_error(monkeypatch):
+    def failing(db):
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(ad_accounting, "expire_ads", failing)
+    run_ad_expiry()
+    assert ad_expiry_status["last_error"] == "database went away"
+
+    monkeypatch.undo()
+    run_ad_expiry()
+    assert "last_error" not in ad_expiry_status
+    assert "last_error_at" not in ad_expiry_status
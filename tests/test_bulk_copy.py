@@ -0,0 +1,64 @@
+import pytest
+from sqlalchemy import event, func, select
+from config import BULK_COPY_THRESHOLD
+from database_connection import engine, async_engine, AsyncSessionLocal
+from ingest_service import ingest_batch
+from models import FactAdMetricsDaily
+
+pytestmark = pytest.mark.skipif(
+    engine.dialect.name != "postgresql",
+    reason="COPY needs PostgreSQL, set TEST_DATABASE_URL",
+)
+
+
+def fact_statements(sync_engine, func_, *args) -> list:
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith(f"INSERT INTO {FactAdMetricsDaily.__tablename__}"):
+            statements.append(statement)
+
+    event.listen(sync_engine, "before_cursor_execute", record)
+    try:
+        func_(*args)
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", record)
+    return statements
+
+
+def fact_count(db, advertise_id) -> int:
+    return db.scalar(
+        select(func.count()).where(FactAdMetricsDaily.advertise_id == advertise_id)
+    )
+
+
+def batch(advertise_id) -> list:
+    return [{"data": {"advertise_id": advertise_id}}] * BULK_COPY_THRESHOLD
+
+
+def test_batch_at_threshold_is_copied_with_psycopg2(db, advertise_id):
+    results = []
+    statements = fact_statements(
+        engine, lambda: results.extend(ingest_batch(db, batch(advertise_id)))
+    )
+
+    assert [r["status"] for r in results] == ["created"] * BULK_COPY_THRESHOLD
+    assert statements == []
+    assert fact_count(db, advertise_id) == BULK_COPY_THRESHOLD
+
+
+def test_batch_at_threshold_is_copied_with_asyncpg(client, db, advertise_id):
+    results = []
+
+    async def run():
+        async with AsyncSessionLocal() as session:
+            results.extend(await session.run_sync(ingest_batch, batch(advertise_id)))
+
+    # On the app's event loop, which owns the pooled asyncpg connections
+    statements = fact_statements(
+        async_engine.sync_engine, lambda: client.portal.call(run)
+    )
+
+    assert [r["status"] for r in results] == ["created"] * BULK_COPY_THRESHOLD
+    assert statements == []
+    assert fact_count(db, advertise_id) == BULK_COPY_THRESHOLD
@@ -0,0 +1,44 @@
+from datetime import date
+from sqlalchemy import insert
+from calendar_dimension import to_date_key
+from click_aggregator import ClickAggregator
+from identifiers import new_id
+from models import FactAdMetricsDaily
+
+
+def test_flush_writes_clicks_to_the_row_of_the_day(db, advertise_id):
+    today = to_date_key(date.today())
+    fact_id = new_id()
+    db.execute(
+        insert(FactAdMetricsDaily).values(
+            id=fact_id, advertise_id=advertise_id, date_key=today, clicks=0
+        )
+    )
+    db.commit()
+
+    aggregator = ClickAggregator(durability="buffered")
+    key = ("user", advertise_id, today)
+    entry = aggregator.remember(key, fact_id, {"clicks": 0})
+    for _ in range(3):
+        aggregator.record_click(key, entry)
+    assert aggregator.flush(db) == 1
+
+    fact = db.get(FactAdMetricsDaily, fact_id)
+    db.refresh(fact)
+    assert (fact.clicks, fact.conversions) == (3, True)
+
+
+def test_sync_clicks_update_the_row_of_the_day(db, advertise_id):
+    today = to_date_key(date.today())
+    fact_id = new_id()
+    db.execute(
+        insert(FactAdMetricsDaily).values(
+            id=fact_id, advertise_id=advertise_id, date_key=today, clicks=0
+        )
+    )
+    db.commit()
+
+    aggregator = ClickAggregator(durability="sync")
+    key = ("user", advertise_id, today)
+    entry = aggregator.remember(key, fact_id, {"clicks": 0})
+    assert aggregator.record_click(key, entry, db=db)["clicks"] == 1
@@ -0,0 +1,27 @@
+import pytest
+from fastapi import HTTPException
+from identifiers import new_id
+from reporting import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    values = [new_id()]
+    cursor = encode_cursor(values)
+    assert decode_cursor(cursor) == values
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        encode_cursor([]),
+        encode_cursor([new_id(), new_id()]),
+        encode_cursor({"id": new_id()}),
+        encode_cursor([None]),
+    ],
+)
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+    assert error.value.detail == "Invalid cursor"
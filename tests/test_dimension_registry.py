@@ -0,0 +1,102 @@
+import uuid
+import pytest
+from sqlalchemy import false, insert, select, text
+from conftest import count_statements
+from database_connection import SessionLocal, engine
+from dimension_registry import (
+    dimension_cache,
+    dimension_key,
+    get_or_create_dimension,
+    natural_key_values,
+)
+from migrations import deduplicate_dimensions
+from models import DimDeviceType, DimRegion, FactAdMetricsDaily
+
+
+def device_name() -> str:
+    return f"device {uuid.uuid4().hex}"
+
+
+def test_cached_once_committed(db):
+    name = device_name()
+    key = dimension_key(DimDeviceType, {"device_name": name})
+    dim_id = get_or_create_dimension(db, DimDeviceType, device_name=name)
+    assert dimension_cache.get(key) is None
+    # Pending rows are reused within the transaction that created them
+    assert get_or_create_dimension(db, DimDeviceType, device_name=name) == dim_id
+
+    db.commit()
+    assert dimension_cache.get(key) == dim_id
+    statements = count_statements(
+        get_or_create_dimension, db, DimDeviceType, device_name=name
+    )
+    assert statements == []
+
+
+def test_discarded_on_rollback(db):
+    name = device_name()
+    get_or_create_dimension(db, DimDeviceType, device_name=name)
+    db.rollback()
+    assert (
+        dimension_cache.get(dimension_key(DimDeviceType, {"device_name": name})) is None
+    )
+    assert "pending_dimensions" not in db.info
+
+
+@pytest.mark.parametrize(
+    "model, values",
+    [
+        (DimDeviceType, {"device_name": device_name()}),
+        # No geo source: every key column is missing
+        (DimRegion, {"regionname": None, "cityname": None, "countryname": None}),
+    ],
+)
+def test_integrity_error_falls_back_to_the_winner(monkeypatch, db, model, values):
+    with SessionLocal() as other:
+        winner = get_or_create_dimension(other, model, **values)
+        other.commit()
+    dimension_cache.pop(dimension_key(model, natural_key_values(model, values)))
+
+    # The lookup misses, as if the other worker had not committed yet
+    query = db.query
+    calls = []
+
+    def lagging_query(*entities):
+        calls.append(entities)
+        result = query(*entities)
+        return result.filter(false()) if len(calls) == 1 else result
+
+    monkeypatch.setattr(db, "query", lagging_query)
+    assert get_or_create_dimension(db, model, **values) == winner
+    assert len(calls) == 2
+    db.commit()
+
+
+def test_deduplicate_repoints_facts_to_the_kept_row():
+    name = device_name()
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(text("DROP INDEX uq_dimdevicetype_natural_key"))
+        ids = [
+            conn.execute(
+                insert(DimDeviceType)
+                .values(device_name=name)
+                .returning(DimDeviceType.id)
+            ).scalar_one()
+            for _ in range(2)
+        ]
+        for dim_id in ids:
+            conn.execute(insert(FactAdMetricsDaily).values(device_type_id=dim_id))
+
+        deduplicate_dimensions(conn)
+
+        kept = conn.execute(
+            select(DimDeviceType.id).where(DimDeviceType.device_name == name)
+        ).scalar_one()
+        referenced = conn.execute(
+            select(FactAdMetricsDaily.device_type_id).where(
+                FactAdMetricsDaily.device_type_id.in_(ids)
+            )
+        ).scalars()
+        assert list(referenced) == [kept, kept]
+        transaction.rollback()
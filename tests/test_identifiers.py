@@ -0,0 +1,43 @@
+import pytest
+import identifiers
+from conftest import auth_headers
+from identifiers import is_valid_id, new_id
+from reporting import encode_cursor
+
+
+@pytest.fixture
+def uuid_keys(monkeypatch):
+    monkeypatch.setattr(identifiers, "PRIMARY_KEY_TYPE", "uuid")
+
+
+def test_is_valid_id(uuid_keys):
+    assert is_valid_id(new_id())
+    assert not is_valid_id("not-a-uuid")
+    assert not is_valid_id(42)
+    assert not is_valid_id(None)
+
+
+def test_click_with_invalid_advertisement_id(client, uuid_keys):
+    response = client.get(
+        "/", headers={**auth_headers(client), "advertisement_id": "not-a-uuid"}
+    )
+    assert response.status_code == 400
+
+
+def test_impression_with_invalid_advertise_id(client, uuid_keys):
+    response = client.post(
+        "/create/fact-ad-matrics/", json={"advertise_id": "not-a-uuid"}
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid advertise_id"
+
+
+@pytest.mark.parametrize("last_id", ["not-a-uuid", 42])
+def test_cursor_with_invalid_id(client, uuid_keys, last_id):
+    response = client.get(
+        "/fact-ad-metrics/",
+        params={"cursor": encode_cursor([last_id])},
+        headers=auth_headers(client),
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
@@ -0,0 +1,38 @@
+from sqlalchemy import select
+from conftest import auth_headers, count_statements
+from ingest_service import ingest_event
+from models import Guestuser, FactAdMetricsDaily
+
+
+def test_guest_impression_statement_count(db, advertise_id):
+    # The first event fills the dimension cache
+    ingest_event(db, advertise_id=advertise_id, client_ip="127.0.0.1")
+
+    statements = count_statements(
+        ingest_event, db, advertise_id=advertise_id, client_ip="127.0.0.1"
+    )
+
+    # Guest user INSERT and fact INSERT ... RETURNING, nothing else
+    assert len(statements) == 2, statements
+    assert statements[0].startswith(f"INSERT INTO {Guestuser.__tablename__} ")
+    assert statements[1].startswith(f"INSERT INTO {FactAdMetricsDaily.__tablename__} ")
+
+
+def test_like_updates_the_existing_row(client, db, advertise_id):
+    headers = auth_headers(client)
+    path = "/create/fact-ad-matrics/"
+    client.post(
+        path, json={"advertise_id": advertise_id, "likes": False}, headers=headers
+    )
+
+    response = client.post(
+        path, json={"advertise_id": advertise_id, "likes": True}, headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json()["likes"] is True
+    likes = db.scalars(
+        select(FactAdMetricsDaily.likes).where(
+            FactAdMetricsDaily.advertise_id == advertise_id
+        )
+    ).all()
+    assert likes == [True]
@@ -0,0 +1,17 @@
+import pytest
+from conftest import auth_headers
+
+
+@pytest.mark.parametrize("path", ["/internal/pool-stats", "/internal/slow-queries"])
+def test_internal_endpoints_are_superadmin_only(client, path):
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers=auth_headers(client)).status_code == 403
+    response = client.get(path, headers=auth_headers(client, superadmin=True))
+    assert response.status_code == 200
+
+
+def test_pool_stats_body(client):
+    response = client.get(
+        "/internal/pool-stats", headers=auth_headers(client, superadmin=True)
+    )
+    assert "password_hasher" in response.json()
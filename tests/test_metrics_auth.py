@@ -0,0 +1,41 @@
+import pytest
+from authentication import decode_access_token
+from conftest import auth_headers
+
+GARBAGE = {"Authorization": "Bearer garbage"}
+
+
+@pytest.mark.parametrize("headers, expected", [({}, 401), (GARBAGE, 401)])
+def test_aggregate_needs_a_valid_token(client, headers, expected):
+    response = client.get("/fact-ad-metrics/aggregate/", headers=headers)
+    assert response.status_code == expected
+
+
+def test_aggregate_with_a_valid_token(client):
+    response = client.get("/fact-ad-metrics/aggregate/", headers=auth_headers(client))
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize("headers, expected", [({}, 401), (GARBAGE, 401)])
+def test_metrics_need_a_valid_token(client, headers, expected):
+    response = client.get("/fact-ad-metrics/", headers=headers)
+    assert response.status_code == expected
+
+
+def user_id_of(headers: dict) -> str:
+    return decode_access_token(headers["Authorization"].split()[1])["id"]
+
+
+@pytest.mark.parametrize("path", ["/fact-ad-metrics/", "/fact-ad-metrics/aggregate/"])
+def test_user_filter_is_limited_to_the_caller(client, path):
+    caller, other = auth_headers(client), auth_headers(client)
+    own = client.get(path, params={"user_id": user_id_of(caller)}, headers=caller)
+    assert own.status_code == 200
+    others = client.get(path, params={"user_id": user_id_of(other)}, headers=caller)
+    assert others.status_code == 403
+
+    superadmin = auth_headers(client, superadmin=True)
+    response = client.get(
+        path, params={"user_id": user_id_of(other)}, headers=superadmin
+    )
+    assert response.status_code == 200
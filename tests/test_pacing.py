@@ -0,0 +1,138 @@
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import func, insert, select
+import ingest_service
+import pacing
+import models
+from ad_index import active_ads, bump_version_statement, refresh_ad_index
+from authentication import decode_access_token
+from calendar_dimension import to_date_key
+from conftest import auth_headers, count_statements
+from database_connection import engine
+from models import AdPacingState, FactAdMetricsDaily
+from pacing import PacingEngine, TokenBucket, ad_bucket, enforce_pacing
+
+
+def test_bucket_is_a_share_of_the_ad(monkeypatch):
+    monkeypatch.setattr(pacing, "PACING_WORKERS", 2)
+    bucket = ad_bucket({"ad_cost": "7200", "ad_run_hours": "1"}, now=0)
+    assert bucket.budget == 3600
+    assert bucket.rate == 1.0
+    assert bucket.tokens == bucket.capacity == 60
+
+
+def test_small_budget_bucket_starts_with_its_budget(monkeypatch):
+    monkeypatch.setattr(pacing, "PACING_WORKERS", 4)
+    bucket = ad_bucket({"ad_cost": "8", "ad_run_hours": "1"}, now=0)
+    assert bucket.budget == 2
+    assert bucket.tokens == 2
+
+
+def test_checkpoints_of_workers_add_up(monkeypatch, db, advertise_id):
+    monkeypatch.setattr(pacing, "AD_PACING", True)
+    monkeypatch.setattr(pacing, "PACING_WORKERS", 2)
+    ad = {"id": advertise_id, "ad_cost": "7200", "ad_run_hours": "1"}
+    monkeypatch.setitem(active_ads.ads, advertise_id, (ad, None))
+
+    workers = [PacingEngine(), PacingEngine()]
+    for worker, events in zip(workers, (3, 2)):
+        for _ in range(events):
+            assert worker.allow(advertise_id, 5)
+        worker.checkpoint(db)
+    assert workers[0].allow(advertise_id, 5)
+    workers[0].checkpoint(db)
+    assert db.get(AdPacingState, advertise_id).spent == 30
+
+    restarted = PacingEngine()
+    restarted.restore(db.get_bind())
+    assert restarted.allow(advertise_id, 5)
+    assert restarted.buckets[advertise_id].spent == 15 + 5
+
+
+def test_refused_click_writes_nothing(monkeypatch, client, db, advertise_id):
+    monkeypatch.setattr(pacing, "AD_PACING", True)
+    monkeypatch.setattr(pacing.pacer, "allow", lambda ad_id, cost: False)
+    headers = auth_headers(client)
+    user_id = decode_access_token(headers["Authorization"].split()[1])["id"]
+    db.execute(
+        insert(FactAdMetricsDaily).values(
+            advertise_id=advertise_id,
+            register_user=user_id,
+            date_key=to_date_key(date.today() - timedelta(days=1)),
+            likes=True,
+        )
+    )
+    db.commit()
+
+    response = client.get("/", headers={**headers, "advertisement_id": advertise_id})
+    assert response.status_code == 429
+    facts = db.scalar(
+        select(func.count()).where(
+            FactAdMetricsDaily.register_user == user_id,
+            FactAdMetricsDaily.date_key == to_date_key(date.today()),
+        )
+    )
+    assert facts == 0
+
+
+def test_token_bucket_refills_at_its_rate_up_to_capacity():
+    bucket = TokenBucket(rate=1.0, capacity=10, budget=100, now=0)
+    assert bucket.take(10, now=0)
+    assert not bucket.take(1, now=0.5)
+    assert bucket.take(5, now=5.5)
+    assert bucket.tokens == pytest.approx(0.5)
+    bucket.take(0, now=1000)
+    assert bucket.tokens == 10
+
+
+def test_token_bucket_stops_at_its_budget():
+    bucket = TokenBucket(rate=100.0, capacity=10, budget=25, now=0)
+    assert bucket.take(10, now=0)
+    assert bucket.take(10, now=1)
+    assert not bucket.take(10, now=2)
+    assert bucket.take(5, now=2)
+    assert bucket.spent == 25
+    assert not bucket.take(1, now=3)
+
+
+def test_refused_take_spends_nothing():
+    bucket = TokenBucket(rate=1.0, capacity=5, budget=100, now=0)
+    assert not bucket.take(6, now=0)
+    assert bucket.tokens == 5
+    assert bucket.spent == 0
+
+
+def test_batch_items_over_the_pace_are_refused(monkeypatch, client, advertise_id):
+    monkeypatch.setattr(pacing, "AD_PACING", True)
+    engine = PacingEngine()
+    # Room for two impressions
+    engine.buckets[advertise_id] = TokenBucket(rate=0.0, capacity=2, budget=100, now=0)
+    monkeypatch.setattr(ingest_service, "pacer", engine)
+
+    response = client.post(
+        "/create/fact-ad-matrics/batch/", json=[{"advertise_id": advertise_id}] * 4
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["paced"]) == (2, 2)
+    assert [item["status"] for item in body["results"]] == ["created"] * 2 + [
+        "paced"
+    ] * 2
+
+
+def test_enforce_pacing_stays_in_memory(monkeypatch, advertise_id):
+    monkeypatch.setattr(pacing, "AD_PACING", True)
+    assert count_statements(enforce_pacing, advertise_id, 1) == []
+
+
+def test_index_refresh_picks_up_other_workers_ads(db):
+    refresh_ad_index(engine)
+    ad = models.Advertisement(ad_promot_company_name="elsewhere", ad_run_hours="1")
+    db.add(ad)
+    db.flush()
+    db.execute(bump_version_statement)
+    db.commit()
+    assert ad.id not in active_ads.ads
+
+    refresh_ad_index(engine)
+    assert ad.id in active_ads.ads
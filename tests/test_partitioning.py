@@ -0,0 +1,69 @@
+from datetime import date
+import pytest
+from sqlalchemy import insert, text
+from calendar_dimension import to_date_key
+from click_aggregator import flush_clicks_statement
+from config import FACT_PARTITION_MONTHS_AHEAD
+from database_connection import engine
+from identifiers import new_id
+from models import FactAdMetricsDaily
+from partitioning import (
+    DEFAULT_PARTITION,
+    add_months,
+    convert_to_partitioned,
+    create_partition,
+    partition_name,
+)
+
+pytestmark = pytest.mark.skipif(
+    engine.dialect.name != "postgresql",
+    reason="partitioning needs PostgreSQL, set TEST_DATABASE_URL",
+)
+
+
+def count(conn, table: str) -> int:
+    return conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+
+def test_create_partition_moves_rows_out_of_default(advertise_id):
+    # Past the months the conversion creates, so the row lands in the default
+    month = add_months(date.today().replace(day=1), FACT_PARTITION_MONTHS_AHEAD + 2)
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            convert_to_partitioned(conn)
+            conn.execute(
+                insert(FactAdMetricsDaily).values(
+                    advertise_id=advertise_id, date_key=to_date_key(month)
+                )
+            )
+            assert count(conn, DEFAULT_PARTITION) == 1
+
+            assert create_partition(conn, month)
+
+            assert count(conn, DEFAULT_PARTITION) == 0
+            assert count(conn, partition_name(month)) == 1
+        finally:
+            transaction.rollback()
+
+
+def test_click_flush_is_pruned_to_one_partition():
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            convert_to_partitioned(conn)
+            statement = flush_clicks_statement.compile(dialect=conn.dialect)
+            plan = conn.exec_driver_sql(
+                f"EXPLAIN {statement}",
+                statement.construct_params(
+                    {
+                        "fact_id": new_id(),
+                        "fact_date_key": to_date_key(date.today()),
+                        "increment": 1,
+                    }
+                ),
+            ).scalars()
+            scans = [line for line in plan if "Scan" in line]
+            assert len(scans) == 1, scans
+        finally:
+            transaction.rollback()
@@ -0,0 +1,21 @@
+import uuid
+from sqlalchemy import text
+import query_profiler
+from cache import LRUCache
+from query_profiler import slow_query_log
+
+
+def test_a_statement_is_explained_once_per_interval(monkeypatch, db):
+    monkeypatch.setattr(query_profiler, "SLOW_QUERY_THRESHOLD_MS", 0)
+    monkeypatch.setattr(query_profiler, "recently_explained", LRUCache(ttl=300))
+    statement = f"SELECT 1 AS probe_{uuid.uuid4().hex}"
+    for _ in range(3):
+        db.execute(text(statement))
+
+    plans = [
+        record["plan"]
+        for record in slow_query_log.snapshot()["records"][::-1]
+        if record["statement"] == statement
+    ]
+    assert len(plans) == 3
+    assert plans[0] and plans[1:] == [None, None]
@@ -0,0 +1,123 @@
+import pytest
+from sqlalchemy import select
+from conftest import auth_headers
+from database_connection import engine
+from identifiers import new_id
+from ingest_service import ingest_event
+from models import ReachSketch
+from reach import (
+    HyperLogLog,
+    backfill_reach_sketches,
+    fold_register,
+    hash_register,
+    reach_sketches,
+    standard_error,
+    visitor_hash,
+)
+
+
+@pytest.mark.parametrize("advertise_id", ["", " ", ",", f"{new_id()},{new_id()}"])
+def test_reach_needs_exactly_one_advertise_id(client, advertise_id):
+    response = client.get(
+        "/fact-ad-metrics/reach/",
+        params={"advertise_id": advertise_id},
+        headers=auth_headers(client),
+    )
+    assert response.status_code == 400
+
+
+def test_reach_of_one_advertise_id(client, advertise_id):
+    response = client.get(
+        "/fact-ad-metrics/reach/",
+        params={"advertise_id": advertise_id},
+        headers=auth_headers(client),
+    )
+    assert response.status_code == 200
+    assert response.json()[0]["advertise_id"] == advertise_id
+
+
+@pytest.mark.parametrize(
+    "headers, expected", [({}, 401), ({"Authorization": "Bearer garbage"}, 401)]
+)
+def test_reach_needs_a_valid_token(client, advertise_id, headers, expected):
+    response = client.get(
+        "/fact-ad-metrics/reach/",
+        params={"advertise_id": advertise_id},
+        headers=headers,
+    )
+    assert response.status_code == expected
+
+
+def hashes(start: int, count: int) -> list:
+    return [visitor_hash(guest_ip=str(i)) for i in range(start, start + count)]
+
+
+def sketch_of(values: list, precision: int) -> HyperLogLog:
+    sketch = HyperLogLog(precision)
+    for value in values:
+        index, rank = hash_register(value, precision)
+        sketch.registers[index] = max(sketch.registers[index], rank)
+    return sketch
+
+
+def test_fold_register_matches_hashing_at_the_lower_precision():
+    for value in hashes(0, 1000):
+        index, rank = hash_register(value, 12)
+        assert fold_register(index, rank, 12, 8) == hash_register(value, 8)
+
+
+def test_fold_register_rank_from_dropped_bits():
+    assert fold_register(0b1011, 3, 4, 2) == (0b10, 1)
+    assert fold_register(0b1001, 3, 4, 2) == (0b10, 2)
+    assert fold_register(0b1000, 3, 4, 2) == (0b10, 5)
+
+
+def test_merge_is_the_sketch_of_the_union():
+    first, second = hashes(0, 3000), hashes(2000, 3000)
+    merged = sketch_of(first, 12)
+    merged.merge(sketch_of(second, 12))
+    assert merged.registers == sketch_of(first + second, 12).registers
+
+    merged.merge(sketch_of(second, 12))
+    assert merged.registers == sketch_of(first + second, 12).registers
+
+
+def test_merge_across_precisions_lowers_to_the_smaller():
+    first, second = hashes(0, 3000), hashes(2000, 3000)
+    merged = sketch_of(first, 12)
+    merged.merge(sketch_of(second, 10))
+    assert merged.precision == 10
+    assert merged.registers == sketch_of(first + second, 10).registers
+
+
+def test_estimate_within_standard_error():
+    estimate = sketch_of(hashes(0, 20000), 12).estimate()
+    assert abs(estimate - 20000) < 20000 * 3 * standard_error(12)
+
+
+def test_repeat_guests_count_once(client, db, advertise_id):
+    for client_ip in ["203.0.113.7"] * 5 + ["203.0.113.8"]:
+        ingest_event(db, advertise_id=advertise_id, client_ip=client_ip)
+    response = client.get(
+        "/fact-ad-metrics/reach/",
+        params={"advertise_id": advertise_id},
+        headers=auth_headers(client),
+    )
+    assert response.json()[0]["reach"] == 2
+
+
+def test_backfill_counts_guests_by_ip(db, advertise_id):
+    for client_ip in ["203.0.113.7"] * 3 + ["203.0.113.8"]:
+        ingest_event(db, advertise_id=advertise_id, client_ip=client_ip)
+    reach_sketches.drain()
+
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        backfill_reach_sketches(conn)
+        registers = conn.execute(
+            select(ReachSketch.registers).where(
+                ReachSketch.advertise_id == advertise_id, ReachSketch.dimension == ""
+            )
+        ).scalar_one()
+        transaction.rollback()
+    assert HyperLogLog.decode(registers).estimate() == 2
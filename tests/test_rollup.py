@@ -0,0 +1,59 @@
+from datetime import date, datetime, timedelta
+import pytest
+from sqlalchemy import insert, select
+import models
+from calendar_dimension import to_date_key
+from config import ROLLUP_OVERLAP_SECONDS
+from models import FactAdMetricsDaily, FactAdMetricsRollup, RollupState
+from rollup import ROLLUP_NAME, refresh_rollup
+
+# Far enough ahead that facts written by other tests fall outside the window
+HIGH_WATER_MARK = datetime(2100, 1, 1)
+
+
+@pytest.fixture
+def high_water_mark(db):
+    state = db.get(RollupState, ROLLUP_NAME)
+    if state is None:
+        state = RollupState(name=ROLLUP_NAME)
+        db.add(state)
+    previous, state.high_water_mark = state.high_water_mark, HIGH_WATER_MARK
+    db.commit()
+    yield
+    db.get(RollupState, ROLLUP_NAME).high_water_mark = previous
+    db.commit()
+
+
+def add_fact(db, updated_at: datetime) -> str:
+    ad = models.Advertisement(ad_promot_company_name="rollup", ad_run_hours="1")
+    db.add(ad)
+    db.commit()
+    db.execute(
+        insert(FactAdMetricsDaily).values(
+            advertise_id=ad.id,
+            date_key=to_date_key(date.today()),
+            impressions=True,
+            updated_at=updated_at,
+        )
+    )
+    db.commit()
+    return str(ad.id)
+
+
+def test_refresh_rereads_the_overlap_window_only(db, high_water_mark):
+    overlap = timedelta(seconds=ROLLUP_OVERLAP_SECONDS)
+    inside = add_fact(db, HIGH_WATER_MARK - overlap / 2)
+    outside = add_fact(db, HIGH_WATER_MARK - overlap * 2)
+
+    status = refresh_rollup(db)
+    assert status["rows_processed"] == 1
+    rolled_up = set(
+        db.scalars(
+            select(FactAdMetricsRollup.advertise_id).where(
+                FactAdMetricsRollup.advertise_id.in_([inside, outside])
+            )
+        )
+    )
+    assert rolled_up == {inside}
+    # A fact older than the mark never moves it back
+    assert db.get(RollupState, ROLLUP_NAME).high_water_mark == HIGH_WATER_MARK